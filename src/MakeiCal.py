@@ -2,78 +2,354 @@
 Generic function for generation of .ics files
 """
 
-import itertools
-import uuid
+import bisect
+import datetime
+from itertools import chain
+import os
 
-vcal_header="""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:1-annum
-"""
+from instrumentation import count, stage
 
-vcal_footer = "END:VCALENDAR"
-
-vevent_rdate_template = """BEGIN:VEVENT
-UID:%s
-DTSTART;VALUE=DATE:%s
-DTEND;VALUE=DATE:%s
-RDATE;VALUE=DATE:%s
-DTSTAMP:20210101T170000Z
-ORGANIZER;CN=Auberon Vacher:MAILTO:contact@1-annum.com
-SUMMARY:%s
-END:VEVENT
-"""
+CRLF = b"\r\n"
 
-vevent_rrule_template="""BEGIN:VEVENT
-UID:%s
-DTSTART;VALUE=DATE:%s
-DTEND;VALUE=DATE:%s
-RRULE:%s
-DTSTAMP:20210101T170000Z
-ORGANIZER;CN=Auberon Vacher:MAILTO:contact@1-annum.com
-SUMMARY: %s 
-END:VEVENT
-"""
+# RFC 5545 3.1: content lines are folded at 75 octets, excluding the CRLF
+FOLD_OCTETS = 75
+
+vcal_header_lines = ("BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:1-annum")
+
+vcal_header = "".join(line + "\r\n" for line in vcal_header_lines)
+
+vcal_footer = "END:VCALENDAR\r\n"
+
+DTSTAMP = "20210101T170000Z"
+ORGANIZER = "ORGANIZER;CN=Auberon Vacher:MAILTO:contact@1-annum.com"
+
+# bytes accumulated before being handed to the underlying file object
+BUFFER_SIZE = 1 << 16
+
+_text_escapes = str.maketrans({"\\": "\\\\", ";": "\\;", ",": "\\,", "\n": "\\n"})
+
+def escape_text(value):
+    """ escapes a TEXT property value (RFC 5545 3.3.11) """
+    return value.translate(_text_escapes)
+
+def fold_line(line):
+    """
+    encodes a content line to UTF-8 and folds it every 75 octets, never
+    inside a multi-octet character; returns bytes ending with CRLF
+    """
+    data = line.encode("utf-8")
+    if len(data) <= FOLD_OCTETS:
+        return data + CRLF
+    out = bytearray()
+    start = 0
+    limit = FOLD_OCTETS
+    while len(data) - start > limit:
+        end = start + limit
+        while data[end] & 0xC0 == 0x80: # UTF-8 continuation byte
+            end -= 1
+        out += data[start:end]
+        out += b"\r\n "
+        start = end
+        limit = FOLD_OCTETS - 1 # the leading space counts
+    out += data[start:]
+    out += CRLF
+    return bytes(out)
+
+def fold_values(prefix, values):
+    """
+    encodes prefix followed by comma separated values, folded between values.
+
+    values must be fixed-width ASCII strings (DATE or DATE-TIME), so the number
+    of values per folded line is computed once and values are only joined a
+    line at a time; values is only iterated once.
+    """
+    lead = prefix
+    line = []
+    limit = None
+    for v in values:
+        if limit is None:
+            width = len(v) + 1
+            limit = max(1, (FOLD_OCTETS - len(prefix)) // width)
+        elif len(line) == limit:
+            yield (lead + ",".join(line) + ",\r\n").encode("ascii")
+            lead = " "
+            limit = (FOLD_OCTETS - 1) // width
+            line = []
+        line.append(v)
+    yield (lead + ",".join(line) + "\r\n").encode("ascii")
+
+# lookup tables of format_dates, built on first use:
+# "%04d" of every year, and "%02d%02d" (month, day) of every day of the year
+_year_digits = []
+_mmdd = {}
+_digits2 = ["%02d" % i for i in range(100)]
+
+def _date_tables():
+    if not _year_digits:
+        _year_digits.extend("%04d" % y for y in range(10000))
+        for year, leap in ((2001, False), (2000, True)):
+            day = datetime.date(year,1,1)
+            _mmdd[leap] = [_digits2[(day + datetime.timedelta(days=i)).month] +
+                           _digits2[(day + datetime.timedelta(days=i)).day]
+                           for i in range(366 if leap else 365)]
+    return _year_digits, _mmdd
+
+def _jan1(year):
+    """ ordinal of the first of january of year """
+    y = year - 1
+    return 365*y + y//4 - y//100 + y//400 + 1
+
+def format_dates(ordinals):
+    """
+    iCalendar DATE values (YYYYMMDD) of an iterable of ordinals.
+
+    Strings are assembled from lookup tables: the year and its day table are
+    only looked up when an ordinal falls outside the year of the previous one,
+    so sorted series cost one subtraction and one concatenation per date.
+    """
+    years, mmdd = _date_tables()
+    start = end = 0
+    for o in ordinals:
+        if not start <= o < end:
+            y = datetime.date.fromordinal(o).year
+            start = _jan1(y)
+            end = _jan1(y + 1)
+            prefix = years[y]
+            days = mmdd[end - start == 366]
+        yield prefix + days[o - start]
+
+def format_date(day):
+    """ iCalendar DATE value of a date """
+    return next(format_dates((day.toordinal(),)))
+
+def format_datetimes(moments):
+    """ iCalendar UTC DATE-TIME values (YYYYMMDDTHHMMSSZ) of an iterable of naive UTC datetimes """
+    years, mmdd = _date_tables()
+    digits2 = _digits2
+    start = end = 0
+    for moment in moments:
+        o = moment.toordinal()
+        if not start <= o < end:
+            y = moment.year
+            start = _jan1(y)
+            end = _jan1(y + 1)
+            prefix = years[y]
+            days = mmdd[end - start == 366]
+        yield "%s%sT%s%s%sZ" % (prefix, days[o - start], digits2[moment.hour],
+                                digits2[moment.minute], digits2[moment.second])
+
+def format_datetime(moment):
+    """ iCalendar UTC DATE-TIME value of a naive UTC datetime """
+    return next(format_datetimes((moment,)))
+
+# uuid (and the hashlib and platform modules it loads) is imported on first
+# use, most imports of this module never write an UID
+_uid_namespace = None
+
+def new_uid():
+    import uuid
+    return str(uuid.uuid4())+"@1-annum.com"
+
+def event_uid(calendar,summary,series):
+    """
+    UID derived from the calendar, the event summary and its series, so that
+    regenerating a calendar yields the same UIDs
+    """
+    global _uid_namespace
+    import uuid
+    if _uid_namespace is None:
+        _uid_namespace = uuid.uuid5(uuid.NAMESPACE_DNS, "1-annum.com")
+    return str(uuid.uuid5(_uid_namespace, "%s/%s/%s" % (calendar,summary,series)))+"@1-annum.com"
+
+def rrule_vevent_lines(date,rrule,summary,uid=None):
+    """ yields the encoded lines of a VEVENT recurring according to rrule """
+    dstart=format_date(date)
+    yield fold_line("BEGIN:VEVENT")
+    yield fold_line("UID:%s" % (uid or new_uid()))
+    yield fold_line("DTSTART;VALUE=DATE:%s" % dstart)
+    yield fold_line("DTEND;VALUE=DATE:%s" % dstart)
+    yield fold_line("RRULE:%s" % rrule)
+    yield fold_line("DTSTAMP:%s" % DTSTAMP)
+    yield fold_line(ORGANIZER)
+    yield fold_line("SUMMARY:%s" % escape_text(summary))
+    yield fold_line("END:VEVENT")
+
+def rdate_vevent_lines(dates,summary,uid=None):
+    """
+    yields the encoded lines of a VEVENT happening on each of dates (an
+    iterable of dates or a DateSeries), which is only iterated once and never
+    held in memory
+    """
+    if hasattr(dates,"yyyymmdd"): # DateSeries
+        values = dates.yyyymmdd()
+    else:
+        values = format_dates(d.toordinal() for d in dates)
+    try:
+        dstart = next(values)
+    except StopIteration:
+        raise ValueError("no dates for %s" % summary) from None
+    yield fold_line("BEGIN:VEVENT")
+    yield fold_line("UID:%s" % (uid or new_uid()))
+    yield fold_line("DTSTART;VALUE=DATE:%s" % dstart)
+    yield fold_line("DTEND;VALUE=DATE:%s" % dstart)
+    yield from fold_values("RDATE;VALUE=DATE:",
+                           chain((dstart,), values))
+    yield fold_line("DTSTAMP:%s" % DTSTAMP)
+    yield fold_line(ORGANIZER)
+    yield fold_line("SUMMARY:%s" % escape_text(summary))
+    yield fold_line("END:VEVENT")
+
+def date_vevent_lines(date,summary,uid=None):
+    """ yields the encoded lines of a VEVENT happening on a single date """
+    dstart=format_date(date)
+    yield fold_line("BEGIN:VEVENT")
+    yield fold_line("UID:%s" % (uid or new_uid()))
+    yield fold_line("DTSTART;VALUE=DATE:%s" % dstart)
+    yield fold_line("DTEND;VALUE=DATE:%s" % dstart)
+    yield fold_line("DTSTAMP:%s" % DTSTAMP)
+    yield fold_line(ORGANIZER)
+    yield fold_line("SUMMARY:%s" % escape_text(summary))
+    yield fold_line("END:VEVENT")
+
+def date_vevents(events,calendar=None):
+    """
+    VEVENTs (as iterables of encoded lines) of a lazy (date, summary) stream
+    such as iter_catho_events(), for ICalWriter.write_events; UIDs are
+    deterministic when calendar is given
+    """
+    for day, summary in events:
+        uid = calendar and event_uid(calendar,summary,format_date(day))
+        yield date_vevent_lines(day,summary,uid)
 
 def get_rrule_vevent(date,rrule,summary):
-    event_uuid = str(uuid.uuid4())+"@1-annum.com"
-    #dstart=date.strftime("%Y%m%dT%H%m%SZ")
-    dstart=date.strftime("%Y%m%d")
-    res = vevent_rrule_template%(event_uuid,dstart,dstart,rrule,summary)
-    return res
+    return b"".join(rrule_vevent_lines(date,rrule,summary)).decode("utf-8")
 
 def get_rdate_vevent(dates,summary):
-    event_uuid = str(uuid.uuid4())+"@1-annum.com"
-    def mygrouper(n, iterable):
-        args = [iter(iterable)] * n
-        return ([e for e in t if e != None] for t in itertools.zip_longest(*args))
-    #dates = [d.strftime("%Y%m%dT%H%m%SZ") for d in dates]
-    dates = [d.strftime("%Y%m%d") for d in dates]
-    dte = dates[0]
-    dts = dates[0]
-    dates = list(mygrouper(3,dates))
-    str_dates = []
-    for d in dates:
-        str_dates.append(",".join(d))
-    rdates=",\n ".join(str_dates)
-    res=vevent_rdate_template%(event_uuid,dte,dts,rdates,summary)
-    return res
-    
-def write_ical(fn,rrules,rdates):
-    with open(fn,"w",encoding='utf-8') as fo:
-        fo.write(vcal_header)
-        for doi in rrules:
-            event_uuid = str(uuid.uuid4())+"@1-annum.com"
-            #get_rrule_vevent(date,rrule,summary)
-            vevent = get_rrule_vevent(rrules[doi]["dtstart"],rrules[doi]["rrule"],doi)
-            fo.write(vevent)
-        for doi in rdates:
-            event_uuid = str(uuid.uuid4())+"@1-annum.com"
-            #get_rdate_vevent(dates,summary)
-            try:
-                vevent = get_rdate_vevent(rdates[doi],doi)
-            except:
-                print(73,doi,rdates[doi])
-                raise
-            fo.write(vevent)
-        fo.write(vcal_footer)
-    print(f"succesfully saved {fn}")
\ No newline at end of file
+    return b"".join(rdate_vevent_lines(dates,summary)).decode("utf-8")
+
+def iter_vevents(rrules,rdates,calendar=None):
+    """
+    VEVENTs (as iterables of encoded lines) for the rrules and rdates dicts of
+    write_ical; UIDs are deterministic when calendar is given
+    """
+    for doi in rrules:
+        uid = calendar and event_uid(calendar,doi,"RRULE")
+        yield rrule_vevent_lines(rrules[doi]["dtstart"],rrules[doi]["rrule"],doi,uid)
+    for doi in rdates:
+        uid = calendar and event_uid(calendar,doi,"RDATE")
+        yield rdate_vevent_lines(rdates[doi],doi,uid)
+
+def rolling_window(past_days=365,future_days=5*365,today=None):
+    """ (first, last) days of a subscriber window around today, for write_ical """
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=past_days), today + datetime.timedelta(days=future_days)
+
+def clip_dates(dates,first,last):
+    """ the dates from first to last included of sorted dates, found by binary search """
+    if hasattr(dates,"window"): # DateSeries
+        return dates.window(first,last)
+    lo = bisect.bisect_left(dates,first)
+    return dates[lo:bisect.bisect_right(dates,last,lo)]
+
+def clip_calendar(rrules,rdates,first,last):
+    """
+    rrules and rdates of write_ical limited to the days from first to last:
+    RDATE lists are clipped, RRULEs start on their first date from first on,
+    and events without any date in the window are left out
+    """
+    # daterules builds on this module through dateseries
+    from daterules import first_occurrence
+    clipped_rrules = {}
+    for summary, rule in rrules.items():
+        dtstart = first_occurrence(rule["rrule"],rule["dtstart"],first,last)
+        if dtstart is not None:
+            clipped_rrules[summary] = dict(rule,dtstart=dtstart)
+    clipped_rdates = {}
+    for summary, dates in rdates.items():
+        dates = clip_dates(dates,first,last)
+        if len(dates):
+            clipped_rdates[summary] = dates
+    return clipped_rrules, clipped_rdates
+
+class ICalWriter:
+    """
+    Streams a VCALENDAR to a binary file-like object (file, sys.stdout.buffer,
+    socket.makefile("wb"), ...) through a single reusable buffer.
+
+        with ICalWriter(fo) as writer:
+            writer.write_events(iter_vevents(rrules,rdates))
+
+    The writes to fo are timed as the "io" stage of metrics, when given.
+    """
+
+    def __init__(self,fo,buffer_size=BUFFER_SIZE,metrics=None):
+        self.fo = fo
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    def __enter__(self):
+        self.write_lines(fold_line(line) for line in vcal_header_lines)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.write_lines((fold_line("END:VCALENDAR"),))
+        self.flush()
+
+    def write_lines(self,lines):
+        """ lines are encoded content lines, as produced by fold_line """
+        buffer = self.buffer
+        for line in lines:
+            buffer += line
+            if len(buffer) >= self.buffer_size:
+                self.flush()
+
+    def write_events(self,events):
+        for event in events:
+            self.write_lines(event)
+
+    def write_rrule_event(self,date,rrule,summary):
+        self.write_lines(rrule_vevent_lines(date,rrule,summary))
+
+    def write_rdate_event(self,dates,summary):
+        self.write_lines(rdate_vevent_lines(dates,summary))
+
+    def flush(self):
+        if self.buffer:
+            with stage(self.metrics,"io"):
+                self.fo.write(self.buffer)
+            self.bytes_written += len(self.buffer)
+            del self.buffer[:]
+
+def write_ical(fn,rrules,rdates,calendar=None,metrics=None,window=None):
+    """
+    fn is either a path or a binary file-like object.
+    calendar names the calendar in the event UIDs: it should not depend on
+    the range of years, so that extending a range keeps the UIDs. It defaults
+    to the file name, and must be given when fn is a file object.
+    metrics (see instrumentation.Metrics) gets the "formatting" and "io" times,
+    the count of events, of dates listed in RDATEs and of bytes written.
+    window, (first, last) days such as rolling_window() returns, only keeps
+    the events of that window (see clip_calendar), with the same UIDs.
+    """
+    if calendar is None and hasattr(fn,"write"):
+        raise ValueError("write_ical needs a calendar to write to a file object")
+    if window is not None:
+        with stage(metrics,"clipping"):
+            rrules, rdates = clip_calendar(rrules,rdates,*window)
+    count(metrics,"events",len(rrules)+len(rdates))
+    count(metrics,"dates",sum(len(dates) for dates in rdates.values()))
+    if hasattr(fn,"write"):
+        with stage(metrics,"formatting"), ICalWriter(fn,metrics=metrics) as writer:
+            writer.write_events(iter_vevents(rrules,rdates,calendar))
+        count(metrics,"bytes",writer.bytes_written)
+        return
+    with stage(metrics,"io"):
+        fo = open(fn,"wb")
+    with fo:
+        with stage(metrics,"formatting"), ICalWriter(fo,metrics=metrics) as writer:
+            writer.write_events(iter_vevents(rrules,rdates,calendar or os.path.basename(fn)))
+        count(metrics,"bytes",writer.bytes_written)
+    print(f"succesfully saved {fn}")
@@ -0,0 +1,342 @@
+""" Timings of the calendar generators
+
+    python benchmarks.py run [--out results.json] [--sizes small,medium,huge]
+    python benchmarks.py compare before.json after.json [--threshold 0.2]
+    python benchmarks.py speedups [40 400 4000]
+    python benchmarks.py imports [--repeat 5]
+
+run times every generator over small/medium/huge year ranges and records the
+peak memory of one more traced run; compare flags the benchmarks that got
+slower (or hungrier) than threshold between two result files and exits with
+status 1 when there is any; speedups compares optimized code paths with the
+implementations they replaced; imports checks with python -X importtime that
+each generator module loads within IMPORT_BUDGETS_MS without pulling in the
+HEAVY_MODULES, and exits with status 1 otherwise.
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import MakeiCal
+import catho2ical
+import doi2ical
+import ephemeris
+import ferie2ical
+import moon2ical
+
+SIZES = {"small": (2000, 2040),
+         "medium": (1700, 2100),
+         "huge": (catho2ical.EASTER_TABLE_START, catho2ical.EASTER_TABLE_END)}
+
+HOLIDAY_COUNTRIES = ("FR", "GB", "DE", "JP")
+
+# cumulative import time allowed to each module, in a fresh interpreter
+IMPORT_BUDGETS_MS = {"MakeiCal": 20, "dateseries": 20, "daterules": 20, "catho2ical": 25,
+                     "doi2ical": 25, "ferie2ical": 25, "moon2ical": 25, "ephemeris": 25}
+
+# dependencies loaded on first use only
+HEAVY_MODULES = ("holidays", "numpy", "uuid", "importlib.metadata")
+
+def best_of(func, *args, repeat=3, setup=None):
+    """ best wall time in seconds of func(*args) over repeat runs """
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup(*args)
+        # write_ical prints the path of every file it saves
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def peak_memory(func, *args, setup=None):
+    """ peak of the memory allocated by func(*args), in KiB """
+    if setup is not None:
+        setup(*args)
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+def cold_tables(*args):
+    """ forgets the easter and advent tables, as in a fresh process """
+    catho2ical._easter_tables.clear()
+    catho2ical._easter.cache_clear()
+
+def cold_holidays(*args):
+    """ empties the holidays caches, so that the holidays package is timed too """
+    ferie2ical._holiday_tables.clear()
+    for fn in os.listdir(ferie2ical.HOLIDAYS_CACHE_DIR):
+        os.remove(os.path.join(ferie2ical.HOLIDAYS_CACHE_DIR, fn))
+
+def all_easters(start, end):
+    for y in range(start, end + 1):
+        catho2ical.easter(y)
+
+@functools.lru_cache(maxsize=None)
+def sample_calendar(start, end):
+    """ rrules and rdates of the size of a catho calendar over [start, end] """
+    easters, ash_weds, pentecosts = catho2ical.get_moving_feasts(start, end)
+    rrules = {"Noel": {"dtstart": datetime.date(start, 12, 25), "rrule": "FREQ=YEARLY;"}}
+    rdates = {"Paques": easters, "Cendres": ash_weds, "Pentecote": pentecosts,
+              "Avent": catho2ical.get_first_advents(start, end)}
+    return rrules, rdates
+
+def benchmarks():
+    """
+    (name, function, setup, sizes): function and setup, run before each call
+    and not timed, are called with (year_start, year_end)
+    """
+    all_sizes = tuple(SIZES)
+    yield "easter", all_easters, cold_tables, all_sizes
+    yield "easter_range", catho2ical.easter_range, cold_tables, all_sizes
+    yield "get_first_advent", lambda s, e: [catho2ical.get_first_advent(y) for y in range(s, e + 1)], \
+        cold_tables, all_sizes
+    yield "get_first_advents", catho2ical.get_first_advents, cold_tables, all_sizes
+    yield "get_list_phases", moon2ical.get_list_phases, None, all_sizes
+    yield "phase_events", lambda s, e: moon2ical.phase_events(datetime.date(s, 1, 1), datetime.date(e + 1, 1, 1)), \
+        None, all_sizes
+    for name in ("get_mothers_days_fr", "get_vattertags_de", "get_oktoberfest",
+                 "get_volkstreuer_tags", "get_debut_soldes"):
+        yield "doi2ical." + name, getattr(doi2ical, name), cold_tables, all_sizes
+    for iso in HOLIDAY_COUNTRIES:
+        # the holidays package is too slow for thousands of years
+        yield "make_country_holiday[%s]" % iso, \
+            (lambda iso: lambda s, e: ferie2ical.make_country_holiday(iso, s, e))(iso), \
+            cold_holidays, ("small", "medium")
+    def write_sample(s, e):
+        rrules, rdates = sample_calendar(s, e)
+        MakeiCal.write_ical("sample_%s_%s.ics" % (s, e), rrules, rdates)
+    # the sample calendar is computed by the setup, only writing is timed
+    yield "write_ical", write_sample, sample_calendar, all_sizes
+
+def run(sizes, repeat=3):
+    """ runs every benchmark, returns the results as a JSON-serializable dict """
+    results = {}
+    cwd = os.getcwd()
+    cache_dir = ferie2ical.HOLIDAYS_CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        # generators write their .ics files to the current directory
+        os.chdir(tmp)
+        ferie2ical.HOLIDAYS_CACHE_DIR = os.path.join(tmp, "holidays")
+        os.makedirs(ferie2ical.HOLIDAYS_CACHE_DIR)
+        try:
+            for name, func, setup, supported in benchmarks():
+                for size in sizes:
+                    if size not in supported:
+                        continue
+                    start, end = SIZES[size]
+                    key = "%s[%s]" % (name, size)
+                    results[key] = {"years": end - start + 1,
+                                    "seconds": best_of(func, start, end, repeat=repeat, setup=setup),
+                                    "peak_kib": peak_memory(func, start, end, setup=setup)}
+                    print("%-40s %10.4fs %10.0f KiB" % (key, results[key]["seconds"], results[key]["peak_kib"]))
+        finally:
+            os.chdir(cwd)
+            ferie2ical.HOLIDAYS_CACHE_DIR = cache_dir
+            ferie2ical._holiday_tables.clear()
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "results": results}
+
+def compare(before, after, threshold=0.2):
+    """ (benchmark, metric, before, after) for every metric that grew by more than threshold """
+    regressions = []
+    for key, old in sorted(before["results"].items()):
+        new = after["results"].get(key)
+        if new is None:
+            continue
+        for metric in ("seconds", "peak_kib"):
+            if old[metric] > 0 and new[metric] > old[metric] * (1 + threshold):
+                regressions.append((key, metric, old[metric], new[metric]))
+    return regressions
+
+def grouper_rdate(dates):
+    """ RDATE line as written before fold_values, three dates per line, with CRLF line ends like it """
+    def mygrouper(n, iterable):
+        args = [iter(iterable)] * n
+        return ([e for e in t if e != None] for t in itertools.zip_longest(*args))
+    dates = list(mygrouper(3,dates))
+    str_dates = []
+    for d in dates:
+        str_dates.append(",".join(d))
+    return ("RDATE;VALUE=DATE:" + ",\r\n ".join(str_dates) + "\r\n").encode("utf-8")
+
+def folded_rdate(dates):
+    return b"".join(MakeiCal.fold_values("RDATE;VALUE=DATE:", dates))
+
+def bench_moon_phases(spans=(40, 400, 4000), year_start=2001):
+    """ day-by-day Decimal loop against the vectorized lunar phase engine """
+    results = []
+    for span in spans:
+        year_end = year_start + span
+        repeat = 1 if span >= 1000 else 3
+        loop = best_of(moon2ical.get_list_phases_loop, year_start, year_end, repeat=repeat)
+        vectorized = best_of(moon2ical.get_list_phases, year_start, year_end)
+        results.append({"name": "get_list_phases", "years": span,
+                        "loop": loop, "vectorized": vectorized,
+                        "speedup": loop / vectorized})
+    return results
+
+def bench_ephemeris(cities=100, years=50):
+    """
+    daily ephemeris of cities spread over the globe, computed day by day
+    (timed over one year and extrapolated) against blocks of days
+    """
+    locations = [("city %d" % i, -60 + 120 * i / cities, -180 + 360 * ((7 * i) % cities) / cities)
+                 for i in range(cities)]
+    first = datetime.date(2000, 1, 1)
+    def compute(last, chunk_days=None):
+        for _ in ephemeris.iter_ephemeris(first, last, locations, chunk_days):
+            pass
+    daily = best_of(compute, datetime.date(2000, 12, 31), 1, repeat=1) * years
+    blocks = best_of(compute, datetime.date(2000 + years - 1, 12, 31), repeat=1)
+    return [{"name": "iter_ephemeris", "cities": cities, "years": years,
+             "daily": daily, "blocks": blocks, "speedup": daily / blocks}]
+
+def bench_rdate_folding(sizes=(10000,)):
+    """ former three-per-line grouper against fold_values on formatted dates """
+    results = []
+    for size in sizes:
+        start = datetime.date(1583,1,1)
+        dates = [(start+datetime.timedelta(days=i)).strftime("%Y%m%d") for i in range(size)]
+        grouper = best_of(grouper_rdate, dates, repeat=10)
+        folded = best_of(folded_rdate, dates, repeat=10)
+        results.append({"name": "rdate_folding", "dates": size,
+                        "grouper": grouper, "fold_values": folded,
+                        "speedup": grouper / folded})
+    return results
+
+def strftime_dates(ordinals):
+    return [datetime.date.fromordinal(o).strftime("%Y%m%d") for o in ordinals]
+
+def formatted_dates(ordinals):
+    return list(MakeiCal.format_dates(ordinals))
+
+def bench_date_formatting(sizes=(100000,)):
+    """ strftime per date against the table-driven format_dates """
+    results = []
+    for size in sizes:
+        start = datetime.date(1583,1,1).toordinal()
+        ordinals = range(start, start + size)
+        strftime = best_of(strftime_dates, ordinals)
+        formatted = best_of(formatted_dates, ordinals)
+        results.append({"name": "date_formatting", "dates": size,
+                        "strftime": strftime, "format_dates": formatted,
+                        "speedup": strftime / formatted})
+    return results
+
+def import_time(module):
+    """
+    (cumulative import time of module in ms, modules it imported) in a fresh
+    interpreter, as reported by python -X importtime
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True, check=True)
+    imported = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imported[name.strip()] = int(cumulative) / 1000
+    return imported[module], set(imported)
+
+def check_imports(repeat=5):
+    """ (module, problem) for every module over budget or importing a heavy module """
+    problems = []
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        runs = [import_time(module) for _ in range(repeat)]
+        best = min(ms for ms, _ in runs)
+        heavy = sorted(set(HEAVY_MODULES).intersection(runs[0][1]))
+        print("%-12s %8.1f ms (budget %d ms)%s" % (module, best, budget,
+                                                   " imports " + ", ".join(heavy) if heavy else ""))
+        if best > budget:
+            problems.append((module, "%.1f ms > %d ms" % (best, budget)))
+        if heavy:
+            problems.append((module, "imports " + ", ".join(heavy)))
+    return problems
+
+def speedups(spans):
+    for res in bench_moon_phases(spans):
+        print("%(name)s %(years)5d years: loop %(loop).3fs, "
+              "vectorized %(vectorized).4fs, x%(speedup).0f" % res)
+    for res in bench_ephemeris():
+        print("%(name)s %(cities)d cities x %(years)d years: day by day ~%(daily).1fs, "
+              "blocks %(blocks).2fs, x%(speedup).0f" % res)
+    for res in bench_rdate_folding():
+        print("%(name)s %(dates)d dates: grouper %(grouper).4fs, "
+              "fold_values %(fold_values).4fs, x%(speedup).1f" % res)
+    for res in bench_date_formatting():
+        print("%(name)s %(dates)d dates: strftime %(strftime).4fs, "
+              "format_dates %(format_dates).4fs, x%(speedup).1f" % res)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the calendar generators")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="time every generator")
+    run_parser.add_argument("--out", help="JSON file for the results")
+    run_parser.add_argument("--sizes", default=",".join(SIZES),
+                            help="comma separated year ranges among %s" % ", ".join(SIZES))
+    run_parser.add_argument("--repeat", type=int, default=3)
+    compare_parser = commands.add_parser("compare", help="flag regressions between two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.2,
+                                help="relative increase reported as a regression")
+    speedups_parser = commands.add_parser("speedups", help="optimized code against former implementations")
+    speedups_parser.add_argument("spans", nargs="*", type=int, default=[40, 400, 4000])
+    imports_parser = commands.add_parser("imports", help="import time of the modules against their budget")
+    imports_parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        sizes = args.sizes.split(",")
+        for size in sizes:
+            if size not in SIZES:
+                parser.error("unknown size %s" % size)
+        results = run(sizes, repeat=args.repeat)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as fo:
+                json.dump(results, fo, indent=1, sort_keys=True)
+    elif args.command == "compare":
+        with open(args.before, encoding="utf-8") as fi:
+            before = json.load(fi)
+        with open(args.after, encoding="utf-8") as fi:
+            after = json.load(fi)
+        regressions = compare(before, after, args.threshold)
+        for key, metric, old, new in regressions:
+            print("%-40s %-8s %12.4f -> %12.4f (+%.0f%%)" % (key, metric, old, new, 100 * (new / old - 1)))
+        if regressions:
+            sys.exit(1)
+        print("no regression")
+    elif args.command == "imports":
+        problems = check_imports(args.repeat)
+        for module, problem in problems:
+            print("%s: %s" % (module, problem))
+        if problems:
+            sys.exit(1)
+    else:
+        speedups(tuple(args.spans))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,357 @@
+""" Builds many calendars at once from a manifest of jobs, in parallel
+
+A manifest is a JSON list of jobs such as:
+
+    [{"generator": "catho", "locale": "fr", "start": 2000, "end": 2040},
+     {"generator": "doi", "locale": "DE", "start": 2000, "end": 2040},
+     {"generator": "holidays", "locale": "JP", "start": 2000, "end": 2040},
+     {"generator": "moon", "start": 1900, "end": 2100},
+     {"generator": "catho", "locale": "en", "start": 1583, "end": 4099, "shard_years": 100}]
+
+Jobs whose parameters, generator code and holidays package version did not
+change since the previous build, and whose outputs are untouched, are skipped:
+the state of the last build is kept in BUILD_STATE inside the output directory.
+
+Jobs with "shard_years" are computed by blocks of years on several workers
+(see shards.py) and merged; each block is cached in SHARD_CACHE, so that
+extending the range of such a job only computes the new blocks.
+
+With --metrics FILE, every job is instrumented (see instrumentation.py) and
+its stage timings and counts are saved to FILE; --profile also dumps the
+cProfile stats of each job to PROFILES in the output directory, and
+--trace-memory records the peak memory of each job.
+
+usage: python build.py [manifest.json] [--workers N] [--outdir DIR] [--force] [--shard-years N]
+                       [--metrics FILE] [--profile] [--trace-memory]
+"""
+
+import argparse
+import ast
+import functools
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from instrumentation import Metrics
+import catho2ical
+import doi2ical
+import ferie2ical
+import moon2ical
+import shards
+
+def build_catho(locale,start,end,metrics=None):
+    catho2ical.make_catho(start,end,langs=(locale,),metrics=metrics)
+
+def build_doi(locale,start,end,metrics=None):
+    {"FR": doi2ical.make_fr, "DE": doi2ical.make_de}[locale](start,end,metrics=metrics)
+
+def build_holidays(locale,start,end,metrics=None):
+    ferie2ical.make_country_holiday(locale,start,end,metrics=metrics)
+
+def build_moon(locale,start,end,metrics=None):
+    moon2ical.make_ical(start,end,metrics=metrics)
+
+GENERATORS = {"catho": build_catho,
+              "doi": build_doi,
+              "holidays": build_holidays,
+              "moon": build_moon}
+
+DEFAULT_MANIFEST = [{"generator": "catho", "locale": "fr", "start": 2000, "end": 2040},
+                    {"generator": "catho", "locale": "en", "start": 2000, "end": 2040},
+                    {"generator": "doi", "locale": "FR", "start": 2000, "end": 2040},
+                    {"generator": "doi", "locale": "DE", "start": 2000, "end": 2040},
+                    {"generator": "holidays", "locale": "FR", "start": 2000, "end": 2040},
+                    {"generator": "holidays", "locale": "GB", "start": 2000, "end": 2040},
+                    {"generator": "holidays", "locale": "DE", "start": 2000, "end": 2040},
+                    {"generator": "holidays", "locale": "JP", "start": 2000, "end": 2040},
+                    {"generator": "moon", "start": 2000, "end": 2040}]
+
+# module of each generator: its code and that of the modules of this
+# directory it imports determine the output (see local_modules)
+GENERATOR_MODULES = {"catho": "catho2ical",
+                     "doi": "doi2ical",
+                     "holidays": "ferie2ical",
+                     "moon": "moon2ical"}
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BUILD_STATE = ".build-state.json"
+
+SHARD_CACHE = ".shards"
+
+PROFILES = "profiles"
+
+def job_outputs(job):
+    """ names of the files written by a job """
+    generator, locale, start, end = job["generator"], job.get("locale"), job["start"], job["end"]
+    if generator == "catho":
+        return ["catho_%s_%s_%s.ics" % (start,end,locale)]
+    if generator == "doi":
+        return ["%s_doi_%s_%s.ics" % (locale,start,end)]
+    if generator == "holidays":
+        return ["%s_ferie_%s_%s.ics" % (locale,start,end)]
+    return ["moon_%s_%s.ics" % (start,end)]
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path,"rb") as fi:
+        for chunk in iter(lambda: fi.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def local_modules(name,found=None):
+    """
+    sorted paths of the module name of SOURCE_DIR and of the modules of
+    SOURCE_DIR it imports, directly or not, at the top or inside functions
+    """
+    found = set() if found is None else found
+    path = os.path.join(SOURCE_DIR,name+".py")
+    if path in found or not os.path.exists(path):
+        return sorted(found)
+    found.add(path)
+    with open(path,encoding="utf-8") as fi:
+        tree = ast.parse(fi.read(),path)
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Import):
+            for alias in node.names:
+                local_modules(alias.name,found)
+        elif isinstance(node,ast.ImportFrom) and not node.level:
+            local_modules(node.module,found)
+    return sorted(found)
+
+@functools.lru_cache(maxsize=None)
+def code_digests(generator,sharded):
+    """ digests of the source files a job of generator runs, the code being read once per build """
+    paths = local_modules(GENERATOR_MODULES[generator])
+    if sharded:
+        # the blocks are computed and merged by shards.py, whose
+        # imports of the other generators do not matter here
+        paths.append(os.path.join(SOURCE_DIR,"shards.py"))
+    return tuple(file_digest(path) for path in paths)
+
+def job_fingerprint(job):
+    """ hash of the job parameters, of the code it runs and of the holidays version """
+    digest = hashlib.sha256(json.dumps(job,sort_keys=True).encode("utf-8"))
+    for code_digest in code_digests(job["generator"],bool(job.get("shard_years"))):
+        digest.update(code_digest.encode("ascii"))
+    if job["generator"] == "holidays":
+        digest.update(ferie2ical.holidays_version().encode("utf-8"))
+    return digest.hexdigest()
+
+def output_record(path):
+    stat = os.stat(path)
+    return {"sha256": file_digest(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def is_up_to_date(job,state,outdir):
+    """
+    True when the previous build ran this job with the same fingerprint and
+    its outputs were not modified since; only stat() is needed for that, the
+    files are hashed again only when their size or mtime changed
+    """
+    previous = state.get(job_name(job))
+    if previous is None or previous["fingerprint"] != job_fingerprint(job):
+        return False
+    for fn in job_outputs(job):
+        record = previous["outputs"].get(fn)
+        path = os.path.join(outdir,fn)
+        if record is None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (record["size"], record["mtime_ns"]) \
+                and file_digest(path) != record["sha256"]:
+            return False
+    return True
+
+def load_state(outdir):
+    try:
+        with open(os.path.join(outdir,BUILD_STATE),encoding="utf-8") as fi:
+            return json.load(fi)
+    except FileNotFoundError:
+        return {}
+
+def save_state(outdir,state):
+    path = os.path.join(outdir,BUILD_STATE)
+    with open(path+".tmp","w",encoding="utf-8") as fo:
+        json.dump(state,fo,indent=1,sort_keys=True)
+    os.replace(path+".tmp",path)
+
+def job_name(job):
+    return "%s %s %s-%s" % (job["generator"], job.get("locale", "-"), job["start"], job["end"])
+
+def check_job(job):
+    if job.get("generator") not in GENERATORS:
+        raise ValueError("unknown generator in %r, expected one of %s" % (job, ", ".join(GENERATORS)))
+    if not ("start" in job and "end" in job):
+        raise ValueError("missing year range in %r" % job)
+    if not isinstance(job.get("shard_years", 1), int) or job.get("shard_years", 1) < 1:
+        raise ValueError("shard_years must be a positive number of years in %r" % job)
+
+def job_years(job):
+    """ first and last year of a job, the end of a holidays job being excluded """
+    if job["generator"] == "holidays":
+        return job["start"], job["end"] - 1
+    return job["start"], job["end"]
+
+def job_shards(job):
+    """ one job per block of job["shard_years"] years """
+    base = {key: job[key] for key in ("generator", "locale") if key in job}
+    return [dict(base, start=start, end=end)
+            for start, end in shards.shard_ranges(*job_years(job), job["shard_years"])]
+
+def shard_path(shard):
+    """ cache file of a shard, relative to the output directory """
+    return os.path.join(SHARD_CACHE, job_fingerprint(shard) + ".json")
+
+def run_shard(shard,path):
+    """ computes a shard in the current process and caches it, returns its wall time in seconds """
+    start = time.perf_counter()
+    result = shards.compute_shard(shard["generator"],shard.get("locale"),shard["start"],shard["end"])
+    with open(path+".tmp","w",encoding="utf-8") as fo:
+        json.dump(result,fo,separators=(",",":"))
+    os.replace(path+".tmp",path)
+    return time.perf_counter() - start
+
+def merge_job(job,outdir,metrics=None):
+    """ writes the output of a sharded job from its cached shards, returns the wall time """
+    start = time.perf_counter()
+    def load():
+        for shard in job_shards(job):
+            with open(os.path.join(outdir,shard_path(shard)),encoding="utf-8") as fi:
+                yield json.load(fi)
+    shards.write_merged(job["generator"],job.get("locale"),job_years(job)[1],
+                        os.path.join(outdir,job_outputs(job)[0]),shards.merge_shards(load()),metrics)
+    return time.perf_counter() - start
+
+def _init_worker(outdir,tables):
+    os.chdir(outdir)
+    catho2ical.load_tables(tables)
+
+def job_metrics(job,instrument):
+    """
+    Metrics of a job for instrument, None or a dict of the Metrics options
+    (profile=True being replaced by the path of the job's stats)
+    """
+    if instrument is None:
+        return None
+    options = dict(instrument)
+    if options.get("profile"):
+        options["profile"] = os.path.join(PROFILES,job_name(job).replace(" ","_")+".prof")
+    return Metrics(job_name(job),**options)
+
+def run_job(job,instrument=None):
+    """
+    runs one job in the current process, returns its wall time in seconds and
+    its metrics as a dict when instrumented
+    """
+    metrics = job_metrics(job,instrument)
+    start = time.perf_counter()
+    GENERATORS[job["generator"]](job.get("locale"),job["start"],job["end"],metrics=metrics)
+    return time.perf_counter() - start, metrics and metrics.as_dict()
+
+def build(manifest,workers=None,outdir=".",force=False,instrument=None,on_metrics=None):
+    """
+    Runs every job of manifest that is not up to date on a pool of processes,
+    which all receive the easter and advent tables computed once here.
+    The blocks of sharded jobs missing from the cache run on the pool too,
+    then the jobs are merged here.
+    Returns (job, wall time in seconds) of the jobs run, in completion order,
+    the time of a sharded job adding up its new blocks and its merge.
+
+    instrument holds the options of the instrumentation.Metrics of each job
+    ({} for timings and counts only, {"profile": True, "trace_memory": True});
+    on_metrics then receives the metrics of each job as a dict.
+    """
+    for job in manifest:
+        check_job(job)
+    outdir = os.path.abspath(outdir)
+    state = load_state(outdir)
+    todo = []
+    for job in manifest:
+        if not force and is_up_to_date(job,state,outdir):
+            print("%-30s up to date" % job_name(job))
+        else:
+            todo.append(job)
+    timings = []
+    if not todo:
+        return timings
+    tables = catho2ical.export_tables()
+    os.makedirs(os.path.join(outdir,SHARD_CACHE),exist_ok=True)
+    if instrument and instrument.get("profile"):
+        os.makedirs(os.path.join(outdir,PROFILES),exist_ok=True)
+    sharded = [job for job in todo if job.get("shard_years")]
+    shard_times = {}
+    def done(job,elapsed,metrics=None):
+        print("%-30s %8.3fs" % (job_name(job), elapsed))
+        if metrics is not None and on_metrics is not None:
+            on_metrics(metrics)
+        timings.append((job,elapsed))
+        state[job_name(job)] = {"job": job,
+                                "fingerprint": job_fingerprint(job),
+                                "outputs": {fn: output_record(os.path.join(outdir,fn))
+                                            for fn in job_outputs(job)}}
+    with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,
+                             initargs=(outdir,tables)) as executor:
+        futures = {executor.submit(run_job,job,instrument): (job,None)
+                   for job in todo if not job.get("shard_years")}
+        for job in sharded:
+            for shard in job_shards(job):
+                path = shard_path(shard)
+                if path not in shard_times and not os.path.exists(os.path.join(outdir,path)):
+                    shard_times[path] = 0.0
+                    futures[executor.submit(run_shard,shard,path)] = (shard,path)
+        for future in as_completed(futures):
+            job, path = futures[future]
+            if path is None:
+                done(job,*future.result())
+            else:
+                elapsed = future.result()
+                print("%-30s %8.3fs" % (job_name(job) + " shard", elapsed))
+                shard_times[path] = elapsed
+    for job in sharded:
+        shards_time = sum(shard_times.get(shard_path(shard),0.0) for shard in job_shards(job))
+        metrics = job_metrics(job,instrument)
+        if metrics is not None:
+            # blocks computed by the workers
+            metrics.timings["shards"] = shards_time
+            if metrics.profile:
+                metrics.profile = os.path.join(outdir,metrics.profile)
+        elapsed = merge_job(job,outdir,metrics)
+        done(job,elapsed + shards_time,metrics and metrics.as_dict())
+    save_state(outdir,state)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds calendars listed in a manifest")
+    parser.add_argument("manifest",nargs="?",help="JSON list of jobs, all calendars by default")
+    parser.add_argument("--workers",type=int,default=None,help="number of processes")
+    parser.add_argument("--outdir",default=".",help="directory for the .ics files")
+    parser.add_argument("--force",action="store_true",help="rebuild up to date calendars too")
+    parser.add_argument("--metrics",help="JSON file for the stage timings and counts of each job")
+    parser.add_argument("--profile",action="store_true",help="with --metrics, cProfile stats of each job")
+    parser.add_argument("--trace-memory",action="store_true",help="with --metrics, peak memory of each job")
+    parser.add_argument("--shard-years",type=int,default=None,
+                        help="compute every job by blocks of years, unless its manifest entry sets shard_years")
+    args = parser.parse_args()
+    manifest = DEFAULT_MANIFEST
+    if args.manifest:
+        with open(args.manifest,encoding="utf-8") as fi:
+            manifest = json.load(fi)
+    if args.shard_years:
+        manifest = [dict({"shard_years": args.shard_years},**job) for job in manifest]
+    instrument = None
+    reports = []
+    if args.metrics:
+        instrument = {"profile": args.profile, "trace_memory": args.trace_memory}
+    start = time.perf_counter()
+    timings = build(manifest,workers=args.workers,outdir=args.outdir,force=args.force,
+                    instrument=instrument,on_metrics=reports.append)
+    if args.metrics:
+        with open(args.metrics,"w",encoding="utf-8") as fo:
+            json.dump(reports,fo,indent=1)
+    print("%d calendars in %.3fs (%.3fs of jobs)" % (len(timings),time.perf_counter()-start,
+                                                    sum(t for _,t in timings)))
+
+if __name__=="__main__":
+    main()
@@ -5,17 +5,31 @@ Western, Orthodox or Julian algorithms.
 """
 
 import datetime
-import itertools
-import uuid
+import functools
+from array import array
 
 from MakeiCal import write_ical
+from instrumentation import measured, stage
+from dateseries import DateSeries
+from daterules import FIRST_ADVENT, EasterOffset, Fixed, calendar_from_rules, iter_rules
 
-__all__ = ["easter", "EASTER_JULIAN", "EASTER_ORTHODOX", "EASTER_WESTERN"]
+__all__ = ["easter", "easter_range", "EASTER_JULIAN", "EASTER_ORTHODOX", "EASTER_WESTERN"]
 
 EASTER_JULIAN = 1
 EASTER_ORTHODOX = 2
 EASTER_WESTERN = 3
 
+# range of the precomputed easter tables (validity of the gregorian methods)
+EASTER_TABLE_START = 1583
+EASTER_TABLE_END = 4099
+
+# days from easter sunday
+ASH_WEDNESDAY = -46
+ASCENSION = 39
+PENTECOST = 49
+
+_easter_tables = {}
+
 
 def easter(year, method=EASTER_WESTERN):
     """
@@ -55,7 +69,14 @@ def easter(year, method=EASTER_WESTERN):
 
     if not (1 <= method <= 3):
         raise ValueError("invalid method")
+    if EASTER_TABLE_START <= year <= EASTER_TABLE_END:
+        return datetime.date.fromordinal(easter_table(method)[year - EASTER_TABLE_START])
+    return _easter(year, method)
 
+
+@functools.lru_cache(maxsize=None)
+def _easter(year, method):
+    """ easter computation itself, see easter() """
     # g - Golden year - 1
     # c - Century
     # h - (23 - Epact) mod 30
@@ -91,106 +112,147 @@ def easter(year, method=EASTER_WESTERN):
     d = 1 + (p + 27 + (p + 6)//40) % 31
     m = 3 + (p + 26)//30
     return datetime.date(int(y), int(m), int(d))
+
+
+def easter_table(method=EASTER_WESTERN):
+    """
+    Ordinals of easter for every year from EASTER_TABLE_START to
+    EASTER_TABLE_END, built on first use and shared afterwards.
+    """
+    table = _easter_tables.get(method)
+    if table is None:
+        if not (1 <= method <= 3):
+            raise ValueError("invalid method")
+        table = array("i", (_easter(y, method).toordinal()
+                            for y in range(EASTER_TABLE_START, EASTER_TABLE_END + 1)))
+        _easter_tables[method] = table
+    return table
+
+
+def easter_range(start_year, end_year, method=EASTER_WESTERN):
+    """
+    Ordinals of easter from start_year to end_year included, as an array('i').
+    """
+    if not (1 <= method <= 3):
+        raise ValueError("invalid method")
+    if EASTER_TABLE_START <= start_year and end_year <= EASTER_TABLE_END:
+        table = easter_table(method)
+        return table[start_year - EASTER_TABLE_START:end_year - EASTER_TABLE_START + 1]
+    return array("i", (easter(y, method).toordinal() for y in range(start_year, end_year + 1)))
+
+
+def easter_offsets(start_year, end_year, offset, method=EASTER_WESTERN):
+    """ DateSeries of the days falling offset days from easter, from start_year to end_year """
+    return DateSeries(easter_range(start_year, end_year, method)) + offset
+
     
 def get_moving_feasts(start_year=2000,end_year=2040):
-    easters = []
-    ash_weds = []
-    pentecosts = []
-    for y in range(start_year,end_year+1):
-
-        easter_day = easter(y)
-        ash_wednesday = easter_day+datetime.timedelta(days=-46)
-        pentecost_day = easter_day+datetime.timedelta(days=49)
-        easters.append(easter_day)
-        ash_weds.append(ash_wednesday)
-        pentecosts.append(pentecost_day)
+    easters = easter_offsets(start_year, end_year, 0)
+    ash_weds = easter_offsets(start_year, end_year, ASH_WEDNESDAY)
+    pentecosts = easter_offsets(start_year, end_year, PENTECOST)
     return easters,ash_weds, pentecosts
     
-def mygrouper2(n, iterable):
-    args = [iter(iterable)] * n
-    return ([e for e in t if e != None] for t in itertools.zip_longest(*args))
-    
-def make_ical2(lang="fr",start_year=2000,end_year=2040):
-    easters,ash_weds, pentecosts = get_moving_feasts()
-    moving_feasts = {"easter":{"dates":easters,"fr":"Pâques","en":"Easter","de":"Ostern"},
-                 "pentecosts":{"dates":pentecosts,"fr":"Pâques","en":"Easter","de":"Ostern"},
-                 "ash":{"dates":ash_weds,"fr":"Mercredi des Cendres","en":"Ash Wednesday","de":"Aschermittwoch"}
-                 }
-    with open("catho_%s_%s_%s.ics"%(start_year,end_year,lang),"w") as fo:
-        fo.write(catho_ical_fixed)
-        for moving in moving_feasts:
-            event_uuid = str(uuid.uuid4())+"@1-annum.com"
-            dates = [d.strftime("%Y%m%dT%H%m%SZ") for d in moving_feasts[moving]["dates"]]
-            dts = dates[0]
-            dte = dates[0]
-            #TODO: since ical lines must be <75 characters - splitting every 4 dates
-            dates = list(mygrouper(3,dates))
-            str_dates = []
-            for d in dates:
-                str_dates.append(",".join(d))
-            dates="\n ".join(str_dates)
-            description = moving_feasts[moving][lang]
-            fo.write(moving_header%(event_uuid,dte,dts,dates,description))
-        fo.write("END:VCALENDAR")
-
-    
 def get_first_advent(year):
     """ Advent Sunday is the fourth Sunday before Christmas Day. """
-    xmas_m1 = datetime.date(year,12,24)
-    sundays_count = 0
-    for i in range(28):
-        day = xmas_m1 + datetime.timedelta(days=-i)
-        if day.weekday() ==6: # MON = 0, SUN = 6
-            sundays_count+=1
-            if sundays_count==4:
-                return day
+    if EASTER_TABLE_START <= year <= EASTER_TABLE_END:
+        return datetime.date.fromordinal(advent_table()[year - EASTER_TABLE_START])
+    return _first_advent(year)
+
+def _first_advent(year):
+    return FIRST_ADVENT.date(year)
+
+def advent_table():
+    """
+    Ordinals of the first Sunday of Advent over the same years as
+    easter_table, built on first use and shared afterwards.
+    """
+    table = _easter_tables.get("advent")
+    if table is None:
+        table = array("i", (_first_advent(y).toordinal()
+                            for y in range(EASTER_TABLE_START, EASTER_TABLE_END + 1)))
+        _easter_tables["advent"] = table
+    return table
+
+def export_tables():
+    """ all the easter and advent tables, built if needed, e.g. to hand to worker processes """
+    for method in (EASTER_JULIAN, EASTER_ORTHODOX, EASTER_WESTERN):
+        easter_table(method)
+    advent_table()
+    return dict(_easter_tables)
+
+def load_tables(tables):
+    """ installs tables obtained from export_tables() """
+    _easter_tables.update(tables)
     
 def get_first_advents(year_start=2000,year_end=2040):
-    first_advents = []
-    for y in range(year_start,year_end+1):
-        first_advents.append(get_first_advent(y))
-    return first_advents
-
-def make_catho(year_start=2000,year_end=2040):
-     
-    easters, ash_weds, pentecosts = get_moving_feasts(start_year=2000,end_year=2040)
-    advents = get_first_advents(year_start=2000,year_end=2040)
-    
-    
-    for lang in ["fr","en"]:
-        feasts = {"Paques":{"fr":"Pâques","en":"Easter"},
-                  "Mercredi des cendres":{"fr":"Mercredi des cendres","en":"Ash Wednesday"},
-                  "Pentecote": {"fr":"Pentecôte","en":"Pentecost"},
-                  "Avent": {"fr":"Avent","en":"Advent"},
-                  "Epiphanie": {"fr":"Epiphanie","en":"Epiphanie"},
-                  "Presentation de Jésus au Temple": {"fr":"Présentation de Jésus au Temple","en":"Presentation Jesus"},
-                  "St Joseph": {"fr": "St Joseph", "en":"St Joseph"},
-                  "Annonciation":{"fr":"Annonciation", "en":"Annonciation"},
-                  "Saints Apotres Pierre et St Paul": {"fr": "Saints Apotres Pierre et St Paul", 
-                                                       "en": "Saints Apotres Pierre et St Paul"},
-                  "Assomption": {"fr":"Assomption","en":"Assomption"},
-                  "Toussaint": {"fr":"Toussaint","en":"All saints"},
-                  "Immaculee Conception": {"fr":"Immaculée Conception","en":"Immaculate Conception"},
-                  "Vigile de Noel": {"fr":"Vigile de Noël","en":"Christmas eve"},
-                  "Noel": {"fr":"Noël","en":"Christmas"},
-                }
-        rdates = {feasts["Paques"][lang]: easters,\
-                  feasts["Mercredi des cendres"][lang]: ash_weds,\
-                  feasts["Pentecote"][lang]: pentecosts,\
-                  feasts["Avent"][lang]: advents
-             }
-        rrules = {feasts["Epiphanie"][lang]:{"dtstart":datetime.date(2000,1,6),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Presentation de Jésus au Temple"][lang]:{"dtstart":datetime.date(2000,2,2),"rrule":"FREQ=YEARLY;"},\
-                  feasts["St Joseph"][lang]:{"dtstart":datetime.date(2000,3,19),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Annonciation"][lang] : {"dtstart":datetime.date(2000,3,25),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Saints Apotres Pierre et St Paul"][lang] : {"dtstart":datetime.date(2000,6,29),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Assomption"][lang] : {"dtstart":datetime.date(2000,8,15),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Toussaint"][lang] : {"dtstart":datetime.date(2000,11,1),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Immaculee Conception"][lang] : {"dtstart":datetime.date(2000,12,8),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Vigile de Noel"][lang] : {"dtstart":datetime.date(2000,12,24),"rrule":"FREQ=YEARLY;"},\
-                  feasts["Noel"][lang] : {"dtstart":datetime.date(2000,12,25),"rrule":"FREQ=YEARLY;"}
-                  }
-        write_ical(f"catho_{year_start}_{year_end}_{lang}.ics",rrules,rdates)
+    if EASTER_TABLE_START <= year_start and year_end <= EASTER_TABLE_END:
+        return DateSeries(advent_table()[year_start - EASTER_TABLE_START:year_end - EASTER_TABLE_START + 1])
+    return DateSeries.from_dates(get_first_advent(y) for y in range(year_start,year_end+1))
+
+FEASTS = {"Paques":{"fr":"Pâques","en":"Easter"},
+          "Mercredi des cendres":{"fr":"Mercredi des cendres","en":"Ash Wednesday"},
+          "Pentecote": {"fr":"Pentecôte","en":"Pentecost"},
+          "Avent": {"fr":"Avent","en":"Advent"},
+          "Epiphanie": {"fr":"Epiphanie","en":"Epiphanie"},
+          "Presentation de Jésus au Temple": {"fr":"Présentation de Jésus au Temple","en":"Presentation Jesus"},
+          "St Joseph": {"fr": "St Joseph", "en":"St Joseph"},
+          "Annonciation":{"fr":"Annonciation", "en":"Annonciation"},
+          "Saints Apotres Pierre et St Paul": {"fr": "Saints Apotres Pierre et St Paul", 
+                                               "en": "Saints Apotres Pierre et St Paul"},
+          "Assomption": {"fr":"Assomption","en":"Assomption"},
+          "Toussaint": {"fr":"Toussaint","en":"All saints"},
+          "Immaculee Conception": {"fr":"Immaculée Conception","en":"Immaculate Conception"},
+          "Vigile de Noel": {"fr":"Vigile de Noël","en":"Christmas eve"},
+          "Noel": {"fr":"Noël","en":"Christmas"},
+         }
+
+# rules of the feasts, the single source of get_catho_calendar and iter_catho_events
+# names the calendar of a language in the event UIDs, for files and feeds alike
+CALENDAR_ID = "catho_%s"
+
+CATHO_RULES = {"Paques": EasterOffset(0),
+               "Mercredi des cendres": EasterOffset(ASH_WEDNESDAY),
+               "Pentecote": EasterOffset(PENTECOST),
+               "Avent": FIRST_ADVENT,
+               "Epiphanie": Fixed(1,6),
+               "Presentation de Jésus au Temple": Fixed(2,2),
+               "St Joseph": Fixed(3,19),
+               "Annonciation": Fixed(3,25),
+               "Saints Apotres Pierre et St Paul": Fixed(6,29),
+               "Assomption": Fixed(8,15),
+               "Toussaint": Fixed(11,1),
+               "Immaculee Conception": Fixed(12,8),
+               "Vigile de Noel": Fixed(12,24),
+               "Noel": Fixed(12,25)}
+
+def iter_moving_feasts(start_year=2000,end_year=None):
+    """ (easter, ash wednesday, pentecost) of each year, lazily, without end by default """
+    for year in range(start_year,(end_year or datetime.MAXYEAR)+1):
+        e = easter(year)
+        yield e, e + datetime.timedelta(days=ASH_WEDNESDAY), e + datetime.timedelta(days=PENTECOST)
+
+def iter_first_advents(year_start=2000,year_end=None):
+    """ first Sunday of Advent of each year, lazily, without end by default """
+    for year in range(year_start,(year_end or datetime.MAXYEAR)+1):
+        yield get_first_advent(year)
+
+def iter_catho_events(year_start=2000,year_end=None,lang="fr"):
+    """ (date, feast) in chronological order, lazily, without end by default """
+    return iter_rules({FEASTS[name][lang]: rule for name, rule in CATHO_RULES.items()},
+                      year_start,year_end)
+
+def get_catho_calendar(year_start=2000,year_end=2040,lang="fr"):
+    """ rrules and rdates of the catholic feasts, as expected by write_ical """
+    return calendar_from_rules({FEASTS[name][lang]: rule for name, rule in CATHO_RULES.items()},
+                               year_start,year_end)
+
+def make_catho(year_start=2000,year_end=2040,langs=("fr","en"),metrics=None):
+    with measured(metrics):
+        for lang in langs:
+            with stage(metrics,"dates"):
+                rrules, rdates = get_catho_calendar(year_start,year_end,lang)
+            write_ical(f"catho_{year_start}_{year_end}_{lang}.ics",rrules,rdates,
+                       calendar=CALENDAR_ID % lang,metrics=metrics)
 
 if __name__=="__main__":
     make_catho()
\ No newline at end of file
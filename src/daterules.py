@@ -0,0 +1,275 @@
+"""
+Declarative yearly date rules evaluated by weekday arithmetic
+
+    OKTOBERFEST = WeekdayOnOrAfter(9, 16, SATURDAY)
+    MOTHERS_DAY_FR = Shift(NthWeekday(5, SUNDAY, -1), 7, colliding=EasterOffset(49))
+
+Each rule gives its date for a year in O(1) with ``ordinal(year)`` / ``date(year)``
+and its dates over a range of years as a DateSeries with ``series(start, end)``
+or lazily with ``iter_dates(start, end)``.
+Rules that RFC 5545 can express also provide their ``rrule``.
+"""
+
+import datetime
+import heapq
+import itertools
+from array import array
+
+from dateseries import DateSeries
+
+MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = range(7)
+
+WEEKDAYS = ("MO","TU","WE","TH","FR","SA","SU")
+
+# days before the first of each month in a common year
+_days_before_month = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+_days_in_month = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def month_start(year, month):
+    """ ordinal of the first day of a month """
+    y = year - 1
+    return (365*y + y//4 - y//100 + y//400 + 1 + _days_before_month[month]
+            + (month > 2 and is_leap(year)))
+
+def days_in_month(year, month):
+    return 29 if month == 2 and is_leap(year) else _days_in_month[month]
+
+def weekday(ordinal):
+    """ MON = 0, SUN = 6, as date.weekday() """
+    return (ordinal - 1) % 7
+
+class Rule:
+    """ a date in every year """
+
+    rrule = None
+
+    def ordinal(self, year):
+        raise NotImplementedError
+
+    def date(self, year):
+        return datetime.date.fromordinal(self.ordinal(year))
+
+    def series(self, year_start, year_end):
+        """ DateSeries of the dates from year_start to year_end included """
+        ordinal = self.ordinal
+        return DateSeries(array("i", [ordinal(y) for y in range(year_start, year_end + 1)]))
+
+    def ordinals(self, year):
+        """ ordinals of the dates in year, in chronological order """
+        return (self.ordinal(year),)
+
+    def iter_dates(self, year_start, year_end=None):
+        """ dates from year_start to year_end included, or without end, computed as iterated """
+        for year in range(year_start, (year_end or datetime.MAXYEAR) + 1):
+            for o in self.ordinals(year):
+                yield datetime.date.fromordinal(o)
+
+    def __add__(self, days):
+        return Offset(self, days)
+
+    def __sub__(self, days):
+        return Offset(self, -days)
+
+class Fixed(Rule):
+    """ same month and day every year """
+
+    def __init__(self, month, day):
+        self.month, self.day = month, day
+        self.rrule = "FREQ=YEARLY;"
+
+    def ordinal(self, year):
+        return month_start(year, self.month) + self.day - 1
+
+class NthWeekday(Rule):
+    """ nth weekday of a month, counted from the end when nth is negative (-1 for the last) """
+
+    def __init__(self, month, weekday, nth):
+        self.month, self.weekday, self.nth = month, weekday, nth
+        self.rrule = "FREQ=YEARLY;BYMONTH=%d;BYDAY=%d%s" % (month, nth, WEEKDAYS[weekday])
+
+    def ordinal(self, year):
+        if self.nth > 0:
+            first = month_start(year, self.month)
+            return first + (self.weekday - weekday(first)) % 7 + 7*(self.nth - 1)
+        last = month_start(year, self.month) + days_in_month(year, self.month) - 1
+        return last - (weekday(last) - self.weekday) % 7 + 7*(self.nth + 1)
+
+class WeekdayOnOrAfter(Rule):
+    """ first weekday falling on or after a day of a month """
+
+    def __init__(self, month, day, weekday):
+        self.month, self.day, self.weekday = month, day, weekday
+
+    def ordinal(self, year):
+        base = month_start(year, self.month) + self.day - 1
+        return base + (self.weekday - weekday(base)) % 7
+
+class WeekdayOnOrBefore(Rule):
+    """ last weekday falling on or before a day of a month """
+
+    def __init__(self, month, day, weekday):
+        self.month, self.day, self.weekday = month, day, weekday
+
+    def ordinal(self, year):
+        base = month_start(year, self.month) + self.day - 1
+        return base - (weekday(base) - self.weekday) % 7
+
+class EasterOffset(Rule):
+    """ days from easter sunday """
+
+    def __init__(self, days, method=None):
+        self.days, self.method = days, method
+
+    def _method(self):
+        # catho2ical builds on this module, hence the late import
+        import catho2ical
+        return catho2ical, self.method or catho2ical.EASTER_WESTERN
+
+    def ordinal(self, year):
+        catho2ical, method = self._method()
+        return catho2ical.easter(year, method).toordinal() + self.days
+
+    def series(self, year_start, year_end):
+        catho2ical, method = self._method()
+        return DateSeries(catho2ical.easter_range(year_start, year_end, method)) + self.days
+
+class Offset(Rule):
+    """ days from the date of another rule """
+
+    def __init__(self, rule, days):
+        self.rule, self.days = rule, days
+
+    def ordinal(self, year):
+        return self.rule.ordinal(year) + self.days
+
+    def series(self, year_start, year_end):
+        return self.rule.series(year_start, year_end) + self.days
+
+class Shift(Rule):
+    """
+    date of rule, moved by days in the years when it falls after a day of the
+    month (after=12) or on the date of another rule (colliding=EasterOffset(49))
+    """
+
+    def __init__(self, rule, days, after=None, colliding=None):
+        self.rule, self.days, self.after, self.colliding = rule, days, after, colliding
+
+    def ordinal(self, year):
+        o = self.rule.ordinal(year)
+        if self.after is not None and o - month_start(year, self.rule.month) + 1 > self.after:
+            return o + self.days
+        if self.colliding is not None and o == self.colliding.ordinal(year):
+            return o + self.days
+        return o
+
+class AnyOf(Rule):
+    """ every date of several rules, e.g. the winter and summer sales """
+
+    def __init__(self, *rules):
+        self.rules = rules
+
+    def ordinal(self, year):
+        raise TypeError("AnyOf has several dates a year, see ordinals()")
+
+    def ordinals(self, year):
+        return sorted(set(o for rule in self.rules for o in rule.ordinals(year)))
+
+    def series(self, year_start, year_end):
+        result = DateSeries()
+        for rule in self.rules:
+            result = result | rule.series(year_start, year_end)
+        return result
+
+FIRST_ADVENT = WeekdayOnOrBefore(12, 3, SUNDAY) # fourth Sunday before Christmas Day
+
+def calendar_from_rules(rules, year_start, year_end):
+    """
+    rrules and rdates, as expected by write_ical, of a dict of name -> rule:
+    rules having an RRULE recur from their date in year_start, the others
+    list their dates
+    """
+    rrules = {}
+    rdates = {}
+    for name, rule in rules.items():
+        if rule.rrule:
+            rrules[name] = {"dtstart": rule.date(year_start), "rrule": rule.rrule}
+        else:
+            rdates[name] = rule.series(year_start, year_end)
+    return rrules, rdates
+
+def parse_rrule(rrule, dtstart):
+    """
+    (rule, last ordinal or None) of the yearly RRULEs written by this package:
+    "FREQ=YEARLY;" on the month and day of dtstart, or
+    "FREQ=YEARLY;BYMONTH=5;BYDAY=-1SU", both with an optional UNTIL=YYYYMMDD
+    """
+    parts = dict(part.split("=", 1) for part in rrule.strip(";").split(";") if part)
+    if parts.pop("FREQ", None) != "YEARLY":
+        raise ValueError("unsupported RRULE %s" % rrule)
+    until = parts.pop("UNTIL", None)
+    if until is not None:
+        until = datetime.date(int(until[:4]), int(until[4:6]), int(until[6:8])).toordinal()
+    if "BYMONTH" in parts and "BYDAY" in parts:
+        month, byday = int(parts.pop("BYMONTH")), parts.pop("BYDAY")
+        rule = NthWeekday(month, WEEKDAYS.index(byday[-2:]), int(byday[:-2] or 1))
+    else:
+        rule = Fixed(dtstart.month, dtstart.day)
+    if parts:
+        raise ValueError("unsupported RRULE %s" % rrule)
+    return rule, until
+
+def expand_rrule(rrule, dtstart, year_end):
+    """ DateSeries of the occurrences of a yearly RRULE from dtstart to year_end included """
+    rule, until = parse_rrule(rrule, dtstart)
+    first, last = dtstart.toordinal(), until or datetime.date(year_end, 12, 31).toordinal()
+    ordinals = array("i")
+    for year in range(dtstart.year, year_end + 1):
+        # a yearly February 29th only happens in leap years
+        if isinstance(rule, Fixed) and rule.day > days_in_month(year, rule.month):
+            continue
+        o = rule.ordinal(year)
+        if o > last:
+            break
+        if o >= first:
+            ordinals.append(o)
+    return DateSeries(ordinals)
+
+def first_occurrence(rrule, dtstart, first, last):
+    """
+    first date of a yearly RRULE starting on dtstart that falls from first
+    to last included, or None
+    """
+    rule, until = parse_rrule(rrule, dtstart)
+    lo = max(dtstart.toordinal(), first.toordinal())
+    hi = last.toordinal() if until is None else min(until, last.toordinal())
+    for year in range(datetime.date.fromordinal(lo).year, datetime.date.fromordinal(hi).year + 1):
+        if isinstance(rule, Fixed) and rule.day > days_in_month(year, rule.month):
+            continue
+        o = rule.ordinal(year)
+        if o > hi:
+            break
+        if o >= lo:
+            return datetime.date.fromordinal(o)
+    return None
+
+def iter_rules(rules, year_start, year_end=None):
+    """
+    (date, name) of a dict of name -> rule from year_start to year_end
+    included, or without end, lazily and in chronological order; events on
+    the same day come in the order of rules
+    """
+    streams = [zip(rule.iter_dates(year_start, year_end), itertools.repeat(i), itertools.repeat(name))
+               for i, (name, rule) in enumerate(rules.items())]
+    for day, _, name in heapq.merge(*streams):
+        yield day, name
+
+def upcoming(events, day, n=5):
+    """
+    the first n events of a chronological (date, name) stream happening on
+    or after day, which must be of the same type as the event dates; the
+    stream is not computed further
+    """
+    return list(itertools.islice(itertools.dropwhile(lambda event: event[0] < day, events), n))
@@ -0,0 +1,123 @@
+"""
+Compact series of dates stored as proleptic Gregorian ordinals
+"""
+
+import bisect
+import datetime
+from array import array
+from collections.abc import Sequence
+
+from MakeiCal import format_dates
+
+__all__ = ["DateSeries"]
+
+fromordinal = datetime.date.fromordinal
+
+class DateSeries(Sequence):
+    """
+    Series of dates backed by an array('i') of ordinals (4 bytes a date
+    instead of a datetime.date object and a list slot).
+
+    It reads as a sequence of datetime.date, and offers:
+
+    * offsetting of every date at once: ``easters + 49``
+    * set operations returning sorted series: ``|``, ``&``, ``-`` between series
+    * YYYYMMDD formatting straight from the ordinals: ``yyyymmdd()``
+    """
+
+    __slots__ = ("ordinals",)
+
+    def __init__(self, ordinals=()):
+        if isinstance(ordinals, array) and ordinals.typecode == "i":
+            self.ordinals = ordinals
+        else:
+            self.ordinals = array("i", ordinals)
+
+    @classmethod
+    def from_dates(cls, dates):
+        return cls(d.toordinal() for d in dates)
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DateSeries(self.ordinals[index])
+        return fromordinal(self.ordinals[index])
+
+    def __iter__(self):
+        return map(fromordinal, self.ordinals)
+
+    def __contains__(self, day):
+        return day.toordinal() in self.ordinals
+
+    def __eq__(self, other):
+        if isinstance(other, DateSeries):
+            return self.ordinals == other.ordinals
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        if len(self) > 6:
+            shown = ", ".join(str(d) for d in self[:3]) + ", ..., " + ", ".join(str(d) for d in self[-3:])
+        else:
+            shown = ", ".join(str(d) for d in self)
+        return "DateSeries([%s])" % shown
+
+    def __reduce__(self):
+        return (DateSeries, (self.ordinals,))
+
+    def append(self, day):
+        self.ordinals.append(day.toordinal())
+
+    def extend(self, dates):
+        if isinstance(dates, DateSeries):
+            self.ordinals.extend(dates.ordinals)
+        else:
+            self.ordinals.extend(d.toordinal() for d in dates)
+
+    def __add__(self, days):
+        """ every date shifted by days """
+        if isinstance(days, datetime.timedelta):
+            days = days.days
+        if not isinstance(days, int):
+            return NotImplemented
+        return DateSeries(array("i", [o + days for o in self.ordinals]))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        """ every date shifted back by an int or timedelta, or the difference of two series """
+        if isinstance(other, DateSeries):
+            return self.difference(other)
+        if isinstance(other, datetime.timedelta):
+            other = other.days
+        if not isinstance(other, int):
+            return NotImplemented
+        return self + -other
+
+    def union(self, other):
+        return DateSeries(sorted(set(self.ordinals).union(other.ordinals)))
+
+    def intersection(self, other):
+        return DateSeries(sorted(set(self.ordinals).intersection(other.ordinals)))
+
+    def difference(self, other):
+        return DateSeries(sorted(set(self.ordinals).difference(other.ordinals)))
+
+    __or__ = union
+    __and__ = intersection
+
+    def window(self, first, last):
+        """ the dates from first to last included of a sorted series, found by binary search """
+        ordinals = self.ordinals
+        lo = bisect.bisect_left(ordinals, first.toordinal())
+        return DateSeries(ordinals[lo:bisect.bisect_right(ordinals, last.toordinal(), lo)])
+
+    def sorted(self):
+        return DateSeries(sorted(self.ordinals))
+
+    def yyyymmdd(self):
+        """ iterator over the dates formatted as iCalendar DATE values """
+        return format_dates(self.ordinals)
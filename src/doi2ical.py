@@ -1,12 +1,39 @@
 """ FR- DOI
 """
 
-import datetime
-import uuid
+from catho2ical import ASCENSION,PENTECOST
+from daterules import (AnyOf, EasterOffset, Fixed, NthWeekday, Shift, WeekdayOnOrAfter,
+                       FIRST_ADVENT, SATURDAY, SUNDAY, WEDNESDAY, calendar_from_rules, iter_rules)
 
-from catho2ical import easter,get_first_advent
+from MakeiCal import write_ical
+from instrumentation import measured, stage
 
-from MakeiCal import vcal_header,get_rrule_vevent,get_rdate_vevent,vcal_footer,write_ical
+# see the getters below for the definition of each day
+MOTHERS_DAY_FR = Shift(NthWeekday(5,SUNDAY,-1),7,colliding=EasterOffset(PENTECOST))
+SOLDES = AnyOf(Shift(NthWeekday(1,WEDNESDAY,2),-7,after=12),
+               Shift(NthWeekday(6,WEDNESDAY,-1),-7,after=28))
+VATERTAG = EasterOffset(ASCENSION)
+OKTOBERFEST = WeekdayOnOrAfter(9,16,SATURDAY)
+VOLKSTRAUERTAG = FIRST_ADVENT - 14
+
+# names the calendar of a country in the event UIDs, for files and feeds alike
+CALENDAR_ID = "%s_doi"
+
+# days of interest of each country: adding one is a matter of adding its rule
+DAYS_OF_INTEREST = {
+    "FR": {"Fête des Mères": MOTHERS_DAY_FR,
+           "Ouverture soldes": SOLDES,
+           "Chandeleur": Fixed(2,2),
+           "Fête des pères": Fixed(6,3),
+           "Fête de la musique": Fixed(6,21),
+           "Journée du patrimoine": NthWeekday(9,SUNDAY,3)},
+    "DE": {"Muttertag": NthWeekday(5,SUNDAY,2),
+           "Martinstag": Fixed(1,11),
+           "Nikolaus": Fixed(12,6),
+           "Vatertags": VATERTAG,
+           "Oktober Fest": OKTOBERFEST,
+           "VolksTreuer": VOLKSTRAUERTAG},
+}
 
 def get_mothers_days_fr(year_start,year_end):
     """
@@ -14,46 +41,21 @@ def get_mothers_days_fr(year_start,year_end):
     sauf si celui-ci coïncide avec la Pentecôte. Dans ce cas, la Fête des Mères 
     est décalée au premier dimanche de juin.
     """
-    mothers_day = []
-    for y in range(year_start,year_end+1):
-        easter_day=easter(y)
-        pentecost_day = easter_day+datetime.timedelta(days=49)
-        idx = (pentecost_day.weekday() + 1) % 7 # MON = 0, SUN = 6 -> SUN = 0 .. SAT = 6
-        if pentecost_day.month==5 and pentecost_day.day>24:
-            mothers_day.append(pentecost_day+datetime.timedelta(days=7))
-        else:
-            for i in range(0,7):
-                last_week_may_day = datetime.date(y,5,31-i)
-                idx= last_week_may_day.weekday()
-                if idx==6:
-                    mothers_day.append(last_week_may_day)
-    return mothers_day
+    return MOTHERS_DAY_FR.series(year_start,year_end)
 
 def get_vattertags_de(year_start,year_end):
     """ Christi Himmelfahrt also 39 Tage nach dem Ostersonntag gefeiert.
     Der volkstümliche Vatertag wird in Deutschland an Christi Himmelfahrt begangen,
     dem 40. Tag des Osterfestkreises.
     """
-    vatertags = []
-    for y in range(year_start,year_end+1):
-        easter_day=easter(y)
-        vatertags.append(easter_day+datetime.timedelta(days=49))
-    return vatertags
+    return VATERTAG.series(year_start,year_end)
 
 def get_oktoberfest(year_start,year_end):
     """
     Eröffnet wird seither am Samstag nach dem 15. September, 
     Ende des Festes ist traditionell der erste Sonntag im Oktober. 
     """
-    oktoberfest_tags = []
-    for y in range(year_start,year_end+1):
-        for dom in range(16,23):
-            oktoberfest_tag=datetime.date(y,9,dom)
-            idx = oktoberfest_tag.weekday() # MON = 0, SUN = 6
-            if idx==5:
-                oktoberfest_tags.append(oktoberfest_tag)
-                break
-    return oktoberfest_tags
+    return OKTOBERFEST.series(year_start,year_end)
 
 def get_volkstreuer_tags(year_start=2000,year_end=2040):
     """
@@ -62,12 +64,7 @@ def get_volkstreuer_tags(year_start=2000,year_end=2040):
 Der Volkstrauertag ist in Deutschland ein staatlicher Gedenktag und gehört zu den sogenannten stillen Tagen.
 Er wird seit 1952 zwei Sonntage vor dem ersten Adventssonntag
     """
-    volkstreuer_tags = []
-    for y in range(year_start,year_end+1):
-        first_advent = get_first_advent(y)
-        volkstreuer_tags.append(first_advent+datetime.timedelta(days=-14))
-    return volkstreuer_tags
-    
+    return VOLKSTRAUERTAG.series(year_start,year_end)
 
 def get_debut_soldes(year_start,year_end):
     """
@@ -82,58 +79,33 @@ def get_debut_soldes(year_start,year_end):
         cette date est avancée à l'avant-dernier mercredi du mois de juin lorsque le dernier mercredi 
         intervient après le 28 du mois.
     """
-    debut_soldes = []
-    prev_wed = None
-    for y in range(year_start,year_end+1):
-        for dom in range(1,15):
-            day = datetime.date(y,1,dom)
-            idx=day.weekday()
-            if idx == 2:
-                if dom<=5:
-                    debut_soldes.append(day+datetime.timedelta(days=7))
-                else:
-                    debut_soldes.append(day)
-                break
-        for dom in range(30,23,-1):
-            day =datetime.date(y,6,dom)
-            idx=day.weekday()
-            if idx == 2:
-                if dom>28:
-                    debut_soldes.append(day+datetime.timedelta(days=-7))
-                else:
-                    debut_soldes.append(day)
-                break
-    return debut_soldes
-        
-
-def make_fr(year_start=2000,year_end=2040):
-    mothers_days = get_mothers_days_fr(year_start=2000,year_end=2040)
-    soldes = get_debut_soldes(year_start=2000,year_end=2040)
-    rdates = {"Fête des Mères": mothers_days,\
-              "Ouverture soldes": soldes
-             }
-    
-    rrules = {"Chandeleur":{"dtstart":datetime.date(2000,2,2),"rrule":"FREQ=YEARLY;"},\
-            "Fête des pères": {"dtstart": datetime.date(2000,6,3),"rrule":"FREQ=YEARLY;"},\
-            "Fête de la musique":{"dtstart": datetime.date(2000,6,21),"rrule":"FREQ=YEARLY;"},\
-            "Journée du patrimoine":{"dtstart":datetime.date(2000,9,17),"rrule":"FREQ=YEARLY;INTERVAL=1;BYDAY=3SU;BYMONTH=6"}
-            }
-    write_ical("FR_doi_%s_%s.ics"%(year_start,year_end),rrules,rdates)
-    
-def make_de(year_start=2000,year_end=2040):
-    vatertags = get_vattertags_de(year_start=2000,year_end=2040)
-    oktoberfest_tags = get_oktoberfest(year_start=2000,year_end=2040)
-    volkstreuer_tags = get_volkstreuer_tags(year_start=2000,year_end=2040)
+    return SOLDES.series(year_start,year_end)
+
+def iter_days_of_interest(country,year_start=2000,year_end=None):
+    """ (date, name) of the days of interest of country in chronological order, lazily, without end by default """
+    return iter_rules(DAYS_OF_INTEREST[country],year_start,year_end)
+
+def get_fr_calendar(year_start=2000,year_end=2040):
+    """ rrules and rdates of the french days of interest, as expected by write_ical """
+    return calendar_from_rules(DAYS_OF_INTEREST["FR"],year_start,year_end)
+
+def make_fr(year_start=2000,year_end=2040,metrics=None):
+    with measured(metrics):
+        with stage(metrics,"dates"):
+            rrules, rdates = get_fr_calendar(year_start,year_end)
+        write_ical("FR_doi_%s_%s.ics"%(year_start,year_end),rrules,rdates,
+                   calendar=CALENDAR_ID % "FR",metrics=metrics)
+
+def get_de_calendar(year_start=2000,year_end=2040):
+    """ rrules and rdates of the german days of interest, as expected by write_ical """
+    return calendar_from_rules(DAYS_OF_INTEREST["DE"],year_start,year_end)
     
-    rrules = {"Muttertag":{"dtstart":datetime.date(2000,5,14),"rrule":"FREQ=YEARLY;BYMONTH=5;BYDAY=2SU"},\
-              "Martinstag":{"dtstart":datetime.date(2000,1,11),"rrule":"FREQ=YEARLY;"},\
-              "Nikolaus":{"dtstart":datetime.date(2000,12,6),"rrule":"FREQ=YEARLY;"}
-             }
-    rdates = {"Vatertags":vatertags,\
-              "Oktober Fest": oktoberfest_tags,\
-              "VolksTreuer": volkstreuer_tags,
-            }
-    write_ical("DE_doi_%s_%s.ics"%(year_start,year_end),rrules,rdates)
+def make_de(year_start=2000,year_end=2040,metrics=None):
+    with measured(metrics):
+        with stage(metrics,"dates"):
+            rrules, rdates = get_de_calendar(year_start,year_end)
+        write_ical("DE_doi_%s_%s.ics"%(year_start,year_end),rrules,rdates,
+                   calendar=CALENDAR_ID % "DE",metrics=metrics)
 
 if __name__=="__main__":
     make_fr(year_start=2000,year_end=2040)
@@ -0,0 +1,320 @@
+""" Daily sun and moon data for many places at once: illumination, sun and moon rise and set
+
+    python ephemeris.py [--start 2000] [--end 2040] [--city Paris:48.857:2.352 ...]
+
+writes ephemeris_<city>_<start>_<end>.ics for every city (CITIES by default),
+with the UTC time of sunrise, sunset, moonrise and moonset and the
+illuminated fraction of the moon of each day.
+
+    for chunk in iter_ephemeris(datetime.date(2000, 1, 1), datetime.date(2049, 12, 31), CITIES):
+        chunk.moonrise   # (days, cities) array of UTC times as fractional ordinals, NaN if none
+
+moon2ical.position() gives the mean lunar phase of one instant; here the low
+precision series of the Astronomical Almanac (sun to 0.01 degree, moon to
+0.3 degree, times to a couple of minutes) are evaluated with numpy for all
+the days and places of a block of days at once. The sun rises and sets in
+closed form from its declination at local noon; the moon moves too fast for
+that, so its altitude is sampled every hour and the horizon crossings are
+interpolated. A day is the local mean solar day of each place (longitude / 15
+hours from UTC), and days are computed by blocks of CHUNK_SAMPLES hourly
+samples x places to bound memory.
+"""
+
+import argparse
+import contextlib
+import datetime
+import math
+import re
+
+from MakeiCal import ICalWriter, date_vevent_lines, event_uid, fold_line, format_date, format_datetimes
+from instrumentation import count, measured, stage
+
+__all__ = ["CITIES", "DailyEphemeris", "iter_ephemeris", "daily_ephemeris", "ephemeris_rows",
+           "ephemeris_vevents", "make_ical"]
+
+# name, latitude and longitude in degrees (north and east positive)
+CITIES = (("Paris", 48.857, 2.352),
+          ("London", 51.507, -0.128),
+          ("Berlin", 52.520, 13.405),
+          ("Munich", 48.137, 11.575),
+          ("Tokyo", 35.690, 139.692),
+          ("New York", 40.713, -74.006))
+
+# 2000-01-01 12:00 UTC, as a fractional ordinal
+J2000 = datetime.date(2000, 1, 1).toordinal() + 0.5
+
+SUN_ALTITUDE = -0.833 # refraction and radius at rise and set
+
+# hourly samples x places of a block of days, 16 MiB per float64 array
+CHUNK_SAMPLES = 1 << 21
+
+# calendars make_ical writes at the same time, well below the usual limit of
+# 1024 open files
+OPEN_FILES = 64
+
+def sun_coordinates(np, d):
+    """ (ecliptic longitude, right ascension, declination) in radians, equation of time in degrees """
+    g = np.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    longitude = np.radians(q + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.00000036 * d)
+    ra = np.arctan2(np.cos(obliquity) * np.sin(longitude), np.cos(longitude))
+    dec = np.arcsin(np.sin(obliquity) * np.sin(longitude))
+    equation = (q - np.degrees(ra) + 180) % 360 - 180
+    return longitude, ra, dec, equation
+
+def moon_coordinates(np, d):
+    """ (ecliptic longitude, latitude, right ascension, declination, horizontal parallax) in radians """
+    t = d / 36525
+    def terms(series, function):
+        return sum(a * function(np.radians(b + c * t)) for a, b, c in series)
+    longitude = np.radians(218.32 + 481267.881 * t + terms(
+        ((6.29, 134.9, 477198.85), (-1.27, 259.2, -413335.38), (0.66, 235.7, 890534.23),
+         (0.21, 269.9, 954397.70), (-0.19, 357.5, 35999.05), (-0.11, 186.6, 966404.05)), np.sin))
+    latitude = np.radians(terms(
+        ((5.13, 93.3, 483202.03), (0.28, 228.2, 960400.87), (-0.28, 318.3, 6003.18),
+         (-0.17, 217.6, -407332.20)), np.sin))
+    parallax = np.radians(0.9508 + terms(
+        ((0.0518, 134.9, 477198.85), (0.0095, 259.2, -413335.38), (0.0078, 235.7, 890534.23),
+         (0.0028, 269.9, 954397.70)), np.cos))
+    obliquity = np.radians(23.439 - 0.00000036 * d)
+    ra = np.arctan2(np.sin(longitude) * np.cos(obliquity) - np.tan(latitude) * np.sin(obliquity),
+                    np.cos(longitude))
+    dec = np.arcsin(np.sin(latitude) * np.cos(obliquity)
+                    + np.cos(latitude) * np.sin(obliquity) * np.sin(longitude))
+    return longitude, latitude, ra, dec, parallax
+
+def sidereal_time(np, d):
+    """ Greenwich mean sidereal time in radians """
+    return np.radians((280.46061837 + 360.98564736629 * d) % 360)
+
+class DailyEphemeris:
+    """
+    data of the days ordinals (one dimensional) for the places of locations:
+    illumination per day, sunrise, sunset, moonrise and moonset per day and
+    place as UTC fractional ordinals (ordinal of the day + fraction of the
+    day), NaN when there is none that day
+    """
+
+    def __init__(self, ordinals, locations, illumination, sunrise, sunset, moonrise, moonset):
+        self.ordinals = ordinals
+        self.locations = locations
+        self.illumination = illumination
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.moonrise = moonrise
+        self.moonset = moonset
+
+    def __len__(self):
+        return len(self.ordinals)
+
+def _sun_times(np, ordinals, latitudes, longitudes):
+    """ (sunrise, sunset) of each day and place, closed form """
+    # local mean noon, in days since J2000
+    noon = ordinals[:, None] - J2000 + 0.5 - longitudes / 360
+    _, _, dec, equation = sun_coordinates(np, noon)
+    phi = np.radians(latitudes)
+    cos_h0 = ((math.sin(math.radians(SUN_ALTITUDE)) - np.sin(phi) * np.sin(dec))
+              / (np.cos(phi) * np.cos(dec)))
+    with np.errstate(invalid="ignore"): # polar days and nights
+        h0 = np.degrees(np.arccos(cos_h0)) / 360
+    transit = noon + J2000 - equation / 360
+    return transit - h0, transit + h0
+
+def _moon_altitude(np, d, phi, lam):
+    """
+    altitude of the moon above its rise and set horizon, in radians, at days
+    d since J2000 for latitudes phi and longitudes lam in radians, all broadcast
+    """
+    _, _, ra, dec, parallax = moon_coordinates(np, d)
+    horizon = 0.7275 * parallax - np.radians(0.5667)
+    hour_angle = sidereal_time(np, d) + lam - ra
+    return np.arcsin(np.sin(phi) * np.sin(dec) + np.cos(phi) * np.cos(dec) * np.cos(hour_angle)) - horizon
+
+def _moon_times(np, first, days, latitudes, longitudes):
+    """ (moonrise, moonset) of each day and place, from hourly altitudes """
+    places = len(latitudes)
+    phi, lam = np.radians(latitudes), np.radians(longitudes)
+    # local days start up to about half a day before or after UTC midnight
+    hours = np.arange(-24, 24 * (days + 1) + 1)
+    times = first + hours / 24
+    d = times - J2000
+    # the moon coordinates are evaluated once per sample for all the places
+    _, _, ra, dec, parallax = moon_coordinates(np, d)
+    horizon = 0.7275 * parallax - np.radians(0.5667)
+    hour_angle = (sidereal_time(np, d) - ra)[:, None] + lam
+    altitude = np.arcsin(np.sin(phi) * np.sin(dec)[:, None]
+                         + np.cos(phi) * np.cos(dec)[:, None] * np.cos(hour_angle))
+    altitude -= horizon[:, None]
+    above = altitude >= 0
+    results = []
+    for crossing in (~above[:-1] & above[1:], above[:-1] & ~above[1:]):
+        sample, place = np.nonzero(crossing)
+        start, end = times[sample], times[sample + 1]
+        before, after = altitude[sample, place], altitude[sample + 1, place]
+        moment = start + before / (before - after) / 24
+        # one regula falsi step within the hour: minutes to seconds
+        middle = _moon_altitude(np, moment - J2000, phi[place], lam[place])
+        left = (middle < 0) == (before < 0)
+        start, before = np.where(left, moment, start), np.where(left, middle, before)
+        end, after = np.where(left, end, moment), np.where(left, after, middle)
+        moment = start + before / (before - after) * (end - start)
+        day = np.floor(moment + longitudes[place] / 360).astype(np.int64) - first
+        inside = (day >= 0) & (day < days)
+        # crossings are in chronological order: the first one of a day is kept
+        cells, kept = np.unique(day[inside] * places + place[inside], return_index=True)
+        result = np.full(days * places, np.nan)
+        result[cells] = moment[inside][kept]
+        results.append(result.reshape(days, places))
+    return results
+
+def _illumination(np, ordinals):
+    """ illuminated fraction of the moon at noon UTC """
+    d = ordinals + 0.5 - J2000
+    sun_longitude = sun_coordinates(np, d)[0]
+    moon_longitude, moon_latitude = moon_coordinates(np, d)[:2]
+    return (1 - np.cos(moon_latitude) * np.cos(moon_longitude - sun_longitude)) / 2
+
+def iter_ephemeris(first, last, locations=CITIES, chunk_days=None):
+    """
+    DailyEphemeris of (name, latitude, longitude) locations from the day first
+    to the day last included, by blocks of chunk_days days (as many as
+    CHUNK_SAMPLES allows by default)
+    """
+    import numpy as np
+    latitudes = np.array([location[1] for location in locations], dtype=np.float64)
+    longitudes = np.array([location[2] for location in locations], dtype=np.float64)
+    if chunk_days is None:
+        chunk_days = max(1, CHUNK_SAMPLES // (24 * max(1, len(locations))) - 2)
+    start, end = first.toordinal(), last.toordinal() + 1
+    for chunk_start in range(start, end, chunk_days):
+        days = min(chunk_days, end - chunk_start)
+        ordinals = np.arange(chunk_start, chunk_start + days, dtype=np.int64)
+        sunrise, sunset = _sun_times(np, ordinals, latitudes, longitudes)
+        moonrise, moonset = _moon_times(np, chunk_start, days, latitudes, longitudes)
+        yield DailyEphemeris(ordinals, locations, _illumination(np, ordinals),
+                             sunrise, sunset, moonrise, moonset)
+
+def daily_ephemeris(first, last, locations=CITIES):
+    """ iter_ephemeris in one DailyEphemeris """
+    import numpy as np
+    chunks = list(iter_ephemeris(first, last, locations))
+    if not chunks:
+        return DailyEphemeris(np.zeros(0, dtype=np.int64), locations, *([np.zeros(0)] +
+                              [np.zeros((0, len(locations)))] * 4))
+    return DailyEphemeris(np.concatenate([c.ordinals for c in chunks]), locations,
+                          *(np.concatenate([getattr(c, field) for c in chunks])
+                            for field in ("illumination", "sunrise", "sunset", "moonrise", "moonset")))
+
+def to_datetimes(values):
+    """ naive UTC datetimes (None for NaN) of an array of fractional ordinals, to the second """
+    import numpy as np
+    values = np.asarray(values, dtype=np.float64)
+    # ordinal 1 is 0001-01-01
+    seconds = np.rint((np.nan_to_num(values, nan=1) - 1) * 86400).astype(np.int64)
+    epoch = datetime.datetime(1, 1, 1)
+    return [None if missing else epoch + datetime.timedelta(seconds=s)
+            for missing, s in zip(np.isnan(values).tolist(), seconds.tolist())]
+
+EVENTS = ("sunrise", "sunset", "moonrise", "moonset")
+
+def ephemeris_rows(chunks):
+    """
+    (date, place, illumination, sunrise, sunset, moonrise, moonset) rows of
+    DailyEphemeris chunks, day by day, times being UTC datetimes or None
+    """
+    for chunk in chunks:
+        days = [datetime.date.fromordinal(o) for o in chunk.ordinals.tolist()]
+        illumination = chunk.illumination.tolist()
+        for j, location in enumerate(chunk.locations):
+            columns = [to_datetimes(getattr(chunk, event)[:, j]) for event in EVENTS]
+            for i, day in enumerate(days):
+                yield (day, location[0], illumination[i]) + tuple(column[i] for column in columns)
+
+def timed_vevent_lines(moment, summary, uid, dts):
+    """ encoded lines of an instantaneous VEVENT, dts being moment formatted """
+    yield fold_line("BEGIN:VEVENT")
+    yield fold_line("UID:%s" % uid)
+    yield fold_line("CATEGORIES:EPHEMERIS")
+    yield fold_line("DTSTAMP:20201231T103500Z")
+    yield fold_line("TRANSP:TRANSPARENT")
+    yield fold_line("STATUS:CONFIRMED")
+    yield fold_line("DTSTART:%s" % dts)
+    yield fold_line("DTEND:%s" % dts)
+    yield fold_line("SUMMARY:%s" % summary)
+    yield fold_line("END:VEVENT")
+
+def ephemeris_vevents(chunks, place, calendar=None):
+    """
+    VEVENTs of the place-th location of DailyEphemeris chunks, for
+    ICalWriter.write_events: the illumination of the moon on each day and
+    the sunrise, sunset, moonrise and moonset of the day at their time
+    """
+    for chunk in chunks:
+        calendar = calendar or "ephemeris/%s" % chunk.locations[place][0]
+        days = [datetime.date.fromordinal(o) for o in chunk.ordinals.tolist()]
+        illumination = chunk.illumination.tolist()
+        columns = [to_datetimes(getattr(chunk, event)[:, place]) for event in EVENTS]
+        for i, day in enumerate(days):
+            summary = "Moon %d%%" % round(100 * illumination[i])
+            yield date_vevent_lines(day, summary, event_uid(calendar, "Moon", format_date(day)))
+            moments = [(column[i], event) for column, event in zip(columns, EVENTS) if column[i] is not None]
+            moments.sort(key=lambda moment: moment[0])
+            for (moment, event), dts in zip(moments, format_datetimes(m[0] for m in moments)):
+                summary = event.capitalize()
+                yield timed_vevent_lines(moment, summary, event_uid(calendar, summary, dts), dts)
+
+def city_file_name(name, year_start, year_end):
+    return "ephemeris_%s_%s_%s.ics" % (re.sub(r"\W+", "_", name).strip("_"), year_start, year_end)
+
+def make_ical(year_start=2000, year_end=2040, locations=CITIES, open_files=OPEN_FILES, metrics=None):
+    """
+    writes ephemeris_<city>_<year_start>_<year_end>.ics for each location;
+    the days are computed block by block for groups of open_files locations
+    at once, whose calendars are written side by side
+    """
+    import numpy as np
+    names = [city_file_name(location[0], year_start, year_end) for location in locations]
+    with measured(metrics):
+        for group in range(0, len(locations), open_files):
+            group_locations = locations[group:group + open_files]
+            with contextlib.ExitStack() as stack:
+                with stage(metrics, "io"):
+                    files = [stack.enter_context(open(fn, "wb")) for fn in names[group:group + open_files]]
+                writers = [stack.enter_context(ICalWriter(fo, metrics=metrics)) for fo in files]
+                chunks = iter_ephemeris(datetime.date(year_start, 1, 1), datetime.date(year_end, 12, 31),
+                                        group_locations)
+                while True:
+                    with stage(metrics, "dates"):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    if metrics is not None:
+                        # a day of illumination, and the rises and sets that happen
+                        count(metrics, "events", chunk.ordinals.size * len(group_locations) +
+                              sum(int(np.count_nonzero(~np.isnan(getattr(chunk, event))))
+                                  for event in EVENTS))
+                    with stage(metrics, "formatting"):
+                        for place, (location, writer) in enumerate(zip(group_locations, writers)):
+                            writer.write_events(ephemeris_vevents((chunk,), place,
+                                                                  "ephemeris/%s" % location[0]))
+            count(metrics, "bytes", sum(writer.bytes_written for writer in writers))
+    return names
+
+def parse_city(value):
+    """ "Paris:48.857:2.352" -> ("Paris", 48.857, 2.352) """
+    name, latitude, longitude = value.rsplit(":", 2)
+    return name, float(latitude), float(longitude)
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the daily sun and moon data of cities")
+    parser.add_argument("--start", type=int, default=2000)
+    parser.add_argument("--end", type=int, default=2040, help="last year, included")
+    parser.add_argument("--city", action="append", type=parse_city,
+                        help="name:latitude:longitude, CITIES by default")
+    args = parser.parse_args()
+    for fn in make_ical(args.start, args.end, args.city or CITIES):
+        print("saved in %s" % fn)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,171 @@
+""" Which feasts, days of interest, holidays and moon phases fall on a day or in a window
+
+    index = EventIndex.build(2000, 2040, holidays=("FR", "DE"))
+    index.window(datetime.date(2026, 10, 19), datetime.date(2026, 10, 25))
+    index.on(datetime.date(2026, 12, 25), category="holidays", country="DE")
+    index.save("events.idx")
+    shared = EventIndex.load("events.idx") # memory-mapped, pages shared by processes
+
+Occurrences are kept sorted by ordinal in parallel int32 columns (ordinal,
+event, second of the day or -1 for a whole day) and looked up with bisect;
+events are (category, country, summary) entries of a small table.
+"""
+
+import bisect
+import datetime
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+import catho2ical
+import doi2ical
+import ferie2ical
+import moon2ical
+
+__all__ = ["EventIndex", "CATEGORIES"]
+
+CATEGORIES = ("catho", "doi", "holidays", "moon")
+
+MAGIC = b"1ANNIDX1"
+HEADER = struct.Struct("<8sII") # magic, occurrences, bytes of the events table
+
+WHOLE_DAY = -1
+
+class EventIndex:
+    """
+    Sorted occurrences of events, answering window queries in O(log n + k)
+    """
+
+    def __init__(self, ordinals, event_ids, seconds, events):
+        self.ordinals = ordinals
+        self.event_ids = event_ids
+        self.seconds = seconds
+        self.events = events
+        self._mapping = None
+
+    @classmethod
+    def from_occurrences(cls, occurrences):
+        """ index of (date or datetime, category, country, summary) in any order """
+        events = []
+        ids = {}
+        rows = []
+        for day, category, country, summary in occurrences:
+            key = (category, country, summary)
+            event_id = ids.get(key)
+            if event_id is None:
+                event_id = ids[key] = len(events)
+                events.append(key)
+            if isinstance(day, datetime.datetime):
+                second = day.hour * 3600 + day.minute * 60 + day.second
+            else:
+                second = WHOLE_DAY
+            rows.append((day.toordinal(), second, event_id))
+        rows.sort()
+        return cls(array("i", [r[0] for r in rows]), array("i", [r[2] for r in rows]),
+                   array("i", [r[1] for r in rows]), events)
+
+    @classmethod
+    def build(cls, year_start=2000, year_end=2040, catho=("fr", "en"), doi=("FR", "DE"),
+              holidays=("FR", "GB", "DE", "JP"), moon=True):
+        """ index of the events of every generator from year_start to year_end included """
+        def occurrences():
+            for lang in catho:
+                for day, name in catho2ical.iter_catho_events(year_start, year_end, lang):
+                    yield day, "catho", lang, name
+            for country in doi:
+                for day, name in doi2ical.iter_days_of_interest(country, year_start, year_end):
+                    yield day, "doi", country, name
+            for iso in holidays:
+                for day, name in ferie2ical.iter_holidays(iso, year_start, year_end):
+                    yield day, "holidays", iso, name
+            if moon:
+                for moment, name in moon2ical.iter_phases(datetime.date(year_start, 1, 1),
+                                                          datetime.date(year_end + 1, 1, 1)):
+                    yield moment, "moon", "", name
+        return cls.from_occurrences(occurrences())
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def _matching(self, category, country):
+        if category is None and country is None:
+            return None
+        return {i for i, (c, loc, _) in enumerate(self.events)
+                if (category is None or c == category) and (country is None or loc == country)}
+
+    def window(self, first, last, category=None, country=None):
+        """
+        (date or datetime, category, country, summary) of the occurrences from
+        the day first to the day last included, in chronological order,
+        optionally only those of a category and/or country ("DE-BY", "fr")
+        """
+        ordinals, event_ids, seconds, events = self.ordinals, self.event_ids, self.seconds, self.events
+        lo = bisect.bisect_left(ordinals, first.toordinal())
+        hi = bisect.bisect_right(ordinals, last.toordinal(), lo)
+        matching = self._matching(category, country)
+        found = []
+        for i in range(lo, hi):
+            event_id = event_ids[i]
+            if matching is not None and event_id not in matching:
+                continue
+            day = datetime.date.fromordinal(ordinals[i])
+            if seconds[i] != WHOLE_DAY:
+                day = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(seconds=seconds[i])
+            found.append((day,) + tuple(events[event_id]))
+        return found
+
+    def on(self, day, category=None, country=None):
+        """ occurrences of a single day, see window() """
+        return self.window(day, day, category, country)
+
+    def save(self, path):
+        """ writes the index in the binary layout read by load() """
+        table = json.dumps(self.events, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with open(path, "wb") as fo:
+            fo.write(HEADER.pack(MAGIC, len(self), len(table)))
+            for column in (self.ordinals, self.event_ids, self.seconds):
+                column = array("i", column)
+                if sys.byteorder == "big":
+                    column.byteswap()
+                fo.write(column.tobytes())
+            fo.write(table)
+
+    @classmethod
+    def load(cls, path):
+        """
+        index memory-mapped from a file written by save(): the columns are
+        read in place, so processes loading the same file share its pages
+        """
+        with open(path, "rb") as fi:
+            data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, table_size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            data.close()
+            raise ValueError("%s is not an event index" % path)
+        view = memoryview(data)
+        columns = []
+        offset = HEADER.size
+        for _ in range(3):
+            column = view[offset:offset + 4 * count].cast("i")
+            if sys.byteorder == "big":
+                column = array("i", column)
+                column.byteswap()
+            columns.append(column)
+            offset += 4 * count
+        events = [tuple(e) for e in json.loads(bytes(view[offset:offset + table_size]).decode("utf-8"))]
+        index = cls(*columns, events)
+        index._mapping = (data, view, columns)
+        return index
+
+    def close(self):
+        """ releases the mapping of a loaded index """
+        if self._mapping is not None:
+            data, view, columns = self._mapping
+            self.ordinals = self.event_ids = self.seconds = self._mapping = None
+            for column in columns:
+                if isinstance(column, memoryview):
+                    column.release()
+            view.release()
+            data.close()
@@ -0,0 +1,163 @@
+""" Binary event store, an alternative output to .ics read in place with mmap or numpy.memmap
+
+    write_calendar_store("FR_doi_2000_2040.evt", *doi2ical.get_fr_calendar(2000, 2040), 2040, "doi")
+    write_moon_store("moon_2000_2040.evt", moon2ical.iter_phases(datetime.date(2000, 1, 1),
+                                                                 datetime.date(2041, 1, 1)))
+    store = EventStore("FR_doi_2000_2040.evt")
+    records = store.records()             # numpy.memmap of RECORD_DTYPE, no parsing
+    store.summary(records["event"][0])
+
+Layout, little-endian:
+
+    header    HEADER: magic, records, events, bytes of the summaries, reserved
+    records   RECORD (16 bytes): ordinal, second of the day (-1 for a whole
+              day), event id, category (index in CATEGORIES), flags
+    offsets   uint32 * (events + 1) into the summaries
+    summaries UTF-8, summary of event i being summaries[offsets[i]:offsets[i+1]]
+
+Records are sorted by (ordinal, second, event).
+"""
+
+import argparse
+import datetime
+import mmap
+import struct
+from array import array
+
+from daterules import expand_rrule
+
+__all__ = ["EventStore", "write_store", "write_calendar_store", "write_moon_store",
+           "CATEGORIES", "FLAG_RRULE", "FLAG_RDATE", "FLAG_TIME"]
+
+CATEGORIES = ("catho", "doi", "holidays", "moon")
+
+# how an occurrence was obtained
+FLAG_RRULE = 1 # expanded from an RRULE
+FLAG_RDATE = 2 # listed in an RDATE
+FLAG_TIME = 4  # the second of the day is set
+
+MAGIC = b"1ANNEVT1"
+HEADER = struct.Struct("<8sIIII")
+RECORD = struct.Struct("<iiIBBH")
+
+WHOLE_DAY = -1
+
+def record_dtype():
+    """ numpy dtype of a record """
+    import numpy as np
+    return np.dtype([("ordinal", "<i4"), ("second", "<i4"), ("event", "<u4"),
+                     ("category", "u1"), ("flags", "u1"), ("reserved", "<u2")])
+
+def write_store(fn, occurrences):
+    """
+    writes (date or datetime, summary, category, flags) occurrences, in any
+    order, to fn; returns the number of records
+    """
+    summaries = {}
+    rows = []
+    for day, summary, category, flags in occurrences:
+        event = summaries.setdefault(summary, len(summaries))
+        if isinstance(day, datetime.datetime):
+            second = day.hour * 3600 + day.minute * 60 + day.second
+            flags |= FLAG_TIME
+        else:
+            second = WHOLE_DAY
+        rows.append((day.toordinal(), second, event, CATEGORIES.index(category), flags))
+    rows.sort()
+    encoded = [s.encode("utf-8") for s in summaries]
+    offsets = array("I", [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    with open(fn, "wb") as fo:
+        fo.write(HEADER.pack(MAGIC, len(rows), len(encoded), offsets[-1], 0))
+        pack = RECORD.pack
+        fo.write(b"".join(pack(*row, 0) for row in rows))
+        fo.write(struct.pack("<%dI" % len(offsets), *offsets))
+        fo.write(b"".join(encoded))
+    return len(rows)
+
+def calendar_occurrences(rrules, rdates, year_end, category):
+    """ occurrences of the rrules and rdates of write_ical, rrules expanded up to year_end """
+    for summary, rule in rrules.items():
+        for day in expand_rrule(rule["rrule"], rule["dtstart"], year_end):
+            yield day, summary, category, FLAG_RRULE
+    for summary, dates in rdates.items():
+        for day in dates:
+            yield day, summary, category, FLAG_RDATE
+
+def write_calendar_store(fn, rrules, rdates, year_end, category):
+    """ write_ical counterpart: the rrules are expanded up to year_end included """
+    return write_store(fn, calendar_occurrences(rrules, rdates, year_end, category))
+
+def write_moon_store(fn, events):
+    """ stores (datetime, phase) moon events such as those of moon2ical.iter_phases """
+    return write_store(fn, ((moment, "Moon - %s" % phase, "moon", 0) for moment, phase in events))
+
+class EventStore:
+    """ read-only view of a store file, mapped in memory """
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as fi:
+            self._data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.events, size, _ = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            self._data.close()
+            raise ValueError("%s is not an event store" % fn)
+        self._offsets_at = HEADER.size + RECORD.size * self.count
+        self._summaries_at = self._offsets_at + 4 * (self.events + 1)
+
+    def __len__(self):
+        return self.count
+
+    def records(self):
+        """ numpy.memmap of the records, with the fields of record_dtype() """
+        import numpy as np
+        return np.memmap(self.fn, dtype=record_dtype(), mode="r", offset=HEADER.size, shape=(self.count,))
+
+    def summary(self, event):
+        start, end = struct.unpack_from("<II", self._data, self._offsets_at + 4 * int(event))
+        return self._data[self._summaries_at + start:self._summaries_at + end].decode("utf-8")
+
+    def __iter__(self):
+        """ (date or datetime, summary, category, flags) of every record """
+        summaries = [self.summary(i) for i in range(self.events)]
+        view = memoryview(self._data)[HEADER.size:self._offsets_at]
+        try:
+            for ordinal, second, event, category, flags, _ in RECORD.iter_unpack(view):
+                day = datetime.date.fromordinal(ordinal)
+                if second != WHOLE_DAY:
+                    day = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(seconds=second)
+                yield day, summaries[event], CATEGORIES[category], flags
+        finally:
+            view.release()
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    import shards
+    parser = argparse.ArgumentParser(description="Writes the events of a generator to a binary store")
+    parser.add_argument("generator", choices=CATEGORIES)
+    parser.add_argument("locale", nargs="?", help="fr/en for catho, FR/DE for doi, ISO code for holidays")
+    parser.add_argument("--start", type=int, default=2000)
+    parser.add_argument("--end", type=int, default=2040, help="last year, included")
+    parser.add_argument("--out", help="store file, <generator>_<locale>_<start>_<end>.evt by default")
+    args = parser.parse_args()
+    rrules, rdates, moments = shards.merge_shards([shards.compute_shard(args.generator, args.locale,
+                                                                        args.start, args.end)])
+    fn = args.out or "_".join(str(p) for p in (args.generator, args.locale, args.start, args.end) if p) + ".evt"
+    if args.generator == "moon":
+        count = write_moon_store(fn, moments)
+    else:
+        count = write_calendar_store(fn, rrules, rdates, args.end, args.generator)
+    print("%d events saved in %s" % (count, fn))
+
+if __name__=="__main__":
+    main()
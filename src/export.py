@@ -0,0 +1,329 @@
+""" Publishes built calendars to several targets at once
+
+    python export.py [manifest.json] [--outdir DIR] [--tree DIR] [--bundle calendars.tar.gz]
+                     [--bucket ROOT/BUCKET] [--gzip] [--brotli] [--concurrency N] [--fsync-batch N]
+
+reads the outputs of the build manifest (build.DEFAULT_MANIFEST by default)
+from --outdir and writes each of them to every target:
+
+    --tree DIR      DIR/<generator>/<locale>/<file>
+    --bundle FILE   one .tar, .tar.gz, .tgz or .zip archive, <generator>/<locale>/<file> inside
+    --bucket DIR    a MinIO-like object store directory: DIR/<generator>/<locale>/<file>,
+                    and the content type, encoding, size and ETag of each object in
+                    DIR/.meta/<generator>/<locale>/<file>.json
+
+Locales are namespaced by generator since they mix languages ("fr" for the
+catholic feasts) and countries ("FR" for holidays), which would collide on
+case-insensitive file systems; the moon calendar goes to moon/<file>.
+
+With --gzip and/or --brotli (needs the brotli package) the precompressed
+<file>.gz and <file>.br are published next to each file, for servers that
+send them as they are.
+
+The transfers run concurrently on threads driven by asyncio, at most
+--concurrency blocking operations at a time. Files are written to
+temporary names, fsync'ed by batches of --fsync-batch files as they come,
+and only renamed into place once every transfer succeeded: a failed export
+leaves the targets as they were.
+
+    sinks = [DirectorySink("public"), ArchiveSink("calendars.zip")]
+    asyncio.run(export([("catho/fr", "catho_2000_2040_fr.ics", data)], sinks, encodings=("gzip",)))
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ["DirectorySink", "ObjectStoreSink", "ArchiveSink", "export", "build_outputs"]
+
+CONTENT_TYPES = {".ics": "text/calendar; charset=utf-8"}
+
+# suffix of the precompressed variants
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+def compressor(encoding):
+    """ function compressing bytes with encoding, "gzip" or "br" """
+    if encoding == "gzip":
+        # no timestamp: the same calendar compresses to the same bytes
+        return lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        try:
+            import brotli
+        except ImportError:
+            raise ImportError("brotli precompression needs the brotli package (pip install brotli)") from None
+        return lambda data: brotli.compress(data, quality=11)
+    raise ValueError("unknown encoding %r, expected one of %s" % (encoding, ", ".join(ENCODINGS)))
+
+def fsync_path(path, directory=False):
+    """ fsync of a file or directory given by its path """
+    flags = os.O_RDONLY
+    if directory:
+        if not hasattr(os, "O_DIRECTORY"): # no directory fsync on Windows
+            return
+        flags |= os.O_DIRECTORY
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DirectorySink:
+    """
+    writes the files to root/<folder>/<name> (root/<name> with by_folder=False):
+    each goes to a temporary file, fsync'ed by batches of fsync_batch files,
+    and all of them are renamed into place by close()
+    """
+
+    def __init__(self, root, by_folder=True, fsync_batch=64):
+        self.root = root
+        self.by_folder = by_folder
+        self.fsync_batch = fsync_batch
+        self._pending = [] # (temporary, path) not fsync'ed yet
+        self._synced = [] # (temporary, path) waiting for close()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.root)
+
+    def path(self, folder, name):
+        if self.by_folder:
+            return os.path.join(self.root, *folder.split("/"), name)
+        return os.path.join(self.root, name)
+
+    def write(self, path, data):
+        """ data written to a temporary file next to path, renamed by close() """
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fo:
+                fo.write(data)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        with self._lock:
+            self._pending.append((temp, path))
+            if len(self._pending) < self.fsync_batch:
+                return
+            batch, self._pending = self._pending, []
+        self._sync(batch)
+
+    def put(self, folder, name, data, encoding=None):
+        self.write(self.path(folder, name), data)
+
+    def _sync(self, batch):
+        for temp, _ in batch:
+            fsync_path(temp)
+        with self._lock:
+            self._synced.extend(batch)
+
+    def close(self):
+        """ fsyncs the files still pending, then renames every file into place """
+        with self._lock:
+            batch, self._pending = self._pending, []
+        self._sync(batch)
+        with self._lock:
+            files, self._synced = self._synced, []
+        directories = set()
+        for temp, path in files:
+            os.replace(temp, path)
+            directories.add(os.path.dirname(path))
+        # the renames themselves
+        for directory in directories:
+            fsync_path(directory, directory=True)
+
+    def abort(self):
+        """ removes the temporary files, nothing was renamed into place yet """
+        with self._lock:
+            files = self._synced + self._pending
+            self._synced, self._pending = [], []
+        for temp, _ in files:
+            try:
+                os.unlink(temp)
+            except FileNotFoundError:
+                pass
+
+class ObjectStoreSink(DirectorySink):
+    """
+    stand-in for an object store bucket: the object <folder>/<name> is the file
+    root/<folder>/<name>, its metadata is root/.meta/<folder>/<name>.json
+    """
+
+    META = ".meta"
+
+    def put(self, folder, name, data, encoding=None):
+        key = "%s/%s" % (folder, name)
+        base = name[:-len(ENCODINGS[encoding])] if encoding else name
+        meta = {"key": key,
+                "size": len(data),
+                # ETag of a single part upload
+                "etag": hashlib.md5(data).hexdigest(),
+                "content_type": CONTENT_TYPES.get(os.path.splitext(base)[1], "application/octet-stream")}
+        if encoding:
+            meta["content_encoding"] = encoding
+        self.write(os.path.join(self.root, *key.split("/")), data)
+        self.write(os.path.join(self.root, self.META, *key.split("/")) + ".json",
+                   json.dumps(meta, sort_keys=True).encode("utf-8"))
+
+class ArchiveSink:
+    """
+    one archive of <folder>/<name> members, tar (.tar, .tar.gz, .tgz) or zip
+    (.zip) after the extension of path; written to a temporary file renamed
+    to path on close
+    """
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = time.time() if mtime is None else mtime
+        self._lock = threading.Lock()
+        if path.endswith(".zip"):
+            self.kind = "zip"
+        elif path.endswith((".tar.gz", ".tgz")):
+            self.kind = "w:gz"
+        elif path.endswith(".tar"):
+            self.kind = "w"
+        else:
+            raise ValueError("unknown archive type of %r, expected .tar, .tar.gz, .tgz or .zip" % path)
+        self._archive = None
+        self._temp = None
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.path)
+
+    def _open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, self._temp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(self.path) + ".",
+                                          suffix=".tmp")
+        os.close(fd)
+        if self.kind == "zip":
+            import zipfile
+            self._archive = zipfile.ZipFile(self._temp, "w", zipfile.ZIP_DEFLATED)
+        else:
+            import tarfile
+            self._archive = tarfile.open(self._temp, self.kind)
+
+    def put(self, folder, name, data, encoding=None):
+        member = "%s/%s" % (folder, name)
+        # members are appended one at a time
+        with self._lock:
+            if self._archive is None:
+                self._open()
+            if self.kind == "zip":
+                import zipfile
+                info = zipfile.ZipInfo(member, time.localtime(self.mtime)[:6])
+                # deflating precompressed files again is wasted time
+                info.compress_type = zipfile.ZIP_STORED if encoding else zipfile.ZIP_DEFLATED
+                self._archive.writestr(info, data)
+            else:
+                import tarfile
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                info.mtime = int(self.mtime)
+                info.mode = 0o644
+                self._archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        with self._lock:
+            if self._archive is None:
+                return
+            self._archive.close()
+            self._archive = None
+            fsync_path(self._temp)
+            os.replace(self._temp, self.path)
+            fsync_path(os.path.dirname(os.path.abspath(self.path)), directory=True)
+
+    def abort(self):
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+                os.unlink(self._temp)
+
+def _read(path):
+    with open(path, "rb") as fi:
+        return fi.read()
+
+async def export(calendars, sinks, concurrency=16, encodings=()):
+    """
+    publishes (folder, name, bytes or path) calendars, folder being a
+    "/"-separated relative path such as "catho/fr", with their variants
+    precompressed with encodings ("gzip", "br"), to every sink, then closes
+    the sinks (or aborts them on failure); at most concurrency reads,
+    compressions or writes run at a time.
+    Returns the number of files written to each sink.
+    """
+    compressors = [(encoding, compressor(encoding)) for encoding in encodings]
+    semaphore = asyncio.BoundedSemaphore(concurrency)
+    async def blocking(function, *args):
+        async with semaphore:
+            return await asyncio.to_thread(function, *args)
+    async def publish(folder, name, source):
+        data = source if isinstance(source, bytes) else await blocking(_read, source)
+        variants = [(name, data, None)]
+        for encoding, compress in compressors:
+            variants.append((name + ENCODINGS[encoding], await blocking(compress, data), encoding))
+        await asyncio.gather(*(blocking(sink.put, folder, variant, content, encoding)
+                               for sink in sinks for variant, content, encoding in variants))
+        return len(variants)
+    # every transfer is over before the sinks are closed or aborted
+    written = await asyncio.gather(*(publish(*calendar) for calendar in calendars), return_exceptions=True)
+    for result in written:
+        if isinstance(result, BaseException):
+            for sink in sinks:
+                sink.abort()
+            raise result
+    await asyncio.gather(*(asyncio.to_thread(sink.close) for sink in sinks))
+    return sum(written)
+
+def build_outputs(manifest, outdir="."):
+    """ (<generator>/<locale> folder, name, path) of the files written by the jobs of a build manifest """
+    import build
+    for job in manifest:
+        for fn in build.job_outputs(job):
+            # the moon calendar is the same for everyone
+            folder = "/".join(p for p in (job["generator"], job.get("locale")) if p)
+            yield folder, fn, os.path.join(outdir, fn)
+
+def main():
+    import build
+    parser = argparse.ArgumentParser(description="Publishes built calendars to several targets")
+    parser.add_argument("manifest", nargs="?", help="JSON list of jobs, all calendars by default")
+    parser.add_argument("--outdir", default=".", help="directory of the .ics files")
+    parser.add_argument("--tree", action="append", default=[], help="directory, one subdirectory per generator and locale")
+    parser.add_argument("--bundle", action="append", default=[], help=".tar, .tar.gz, .tgz or .zip archive")
+    parser.add_argument("--bucket", action="append", default=[], help="object store bucket directory")
+    parser.add_argument("--gzip", action="store_true", help="publish .gz precompressed files too")
+    parser.add_argument("--brotli", action="store_true", help="publish .br precompressed files too")
+    parser.add_argument("--concurrency", type=int, default=16, help="blocking operations at a time")
+    parser.add_argument("--fsync-batch", type=int, default=64, help="files renamed per fsync batch")
+    args = parser.parse_args()
+    manifest = build.DEFAULT_MANIFEST
+    if args.manifest:
+        with open(args.manifest, encoding="utf-8") as fi:
+            manifest = json.load(fi)
+    sinks = ([DirectorySink(root, fsync_batch=args.fsync_batch) for root in args.tree] +
+             [ArchiveSink(path) for path in args.bundle] +
+             [ObjectStoreSink(root, fsync_batch=args.fsync_batch) for root in args.bucket])
+    if not sinks:
+        parser.error("no target, use --tree, --bundle or --bucket")
+    encodings = [e for e, wanted in (("gzip", args.gzip), ("br", args.brotli)) if wanted]
+    try:
+        for encoding in encodings:
+            compressor(encoding)
+    except ImportError as e:
+        parser.error(str(e))
+    start = time.perf_counter()
+    written = asyncio.run(export(list(build_outputs(manifest, args.outdir)), sinks,
+                                 args.concurrency, encodings))
+    print("%d files published to %d targets in %.3fs" % (written, len(sinks), time.perf_counter() - start))
+
+if __name__=="__main__":
+    main()
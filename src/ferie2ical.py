@@ -2,12 +2,104 @@
 moving catholic moving feast generator
 """
 
-import holidays
+import functools
 import itertools
+import os
+import threading
 from datetime import date
-import uuid
 
 from MakeiCal import write_ical
+from instrumentation import measured, stage
+from dateseries import DateSeries
+from daterules import NthWeekday, days_in_month
+
+# years asked at once to the holidays package when iterating lazily
+HOLIDAYS_CHUNK_YEARS = 10
+
+# subdivision used when only a country code is requested
+DEFAULT_SUBDIVISIONS = {"DE": "BY"}
+
+# names the calendar of a country in the event UIDs, for files and feeds alike
+CALENDAR_ID = "%s_ferie"
+
+HOLIDAYS_CACHE_DIR = os.environ.get("HOLIDAYS_CACHE_DIR",
+                                    os.path.join(os.path.expanduser("~"),".cache","1-annum","holidays"))
+
+# (country, subdivision) -> {year: [(ordinal, name), ...]} loaded from the disk cache
+_holiday_tables = {}
+# one lock per (country, subdivision), computing the holidays of a country
+# does not hold back the others; _holiday_tables_lock only guards _table_locks
+_table_locks = {}
+_holiday_tables_lock = threading.Lock()
+
+def parse_iso(iso):
+    """ "DE-BY" -> ("DE", "BY"), "FR" -> ("FR", None), "DE" -> ("DE", "BY") """
+    country, _, subdiv = iso.partition("-")
+    return country, subdiv or DEFAULT_SUBDIVISIONS.get(country)
+
+@functools.lru_cache(maxsize=None)
+def holidays_version():
+    # importlib.metadata, json and tempfile are only needed once holidays are asked
+    from importlib import metadata
+    try:
+        return metadata.version("holidays")
+    except metadata.PackageNotFoundError:
+        return ""
+
+def _cache_path(country,subdiv):
+    name = "%s-%s-%s.json" % (country,subdiv or "",holidays_version())
+    return os.path.join(HOLIDAYS_CACHE_DIR,name)
+
+def _load_table(country,subdiv):
+    key = (country,subdiv)
+    table = _holiday_tables.get(key)
+    if table is None:
+        import json
+        try:
+            with open(_cache_path(country,subdiv),encoding="utf-8") as fi:
+                table = {int(year): [tuple(e) for e in entries] for year, entries in json.load(fi).items()}
+        except (FileNotFoundError, ValueError):
+            table = {}
+        _holiday_tables[key] = table
+    return table
+
+def _save_table(country,subdiv,table):
+    import json, tempfile
+    path = _cache_path(country,subdiv)
+    try:
+        os.makedirs(HOLIDAYS_CACHE_DIR,exist_ok=True)
+        with tempfile.NamedTemporaryFile("w",encoding="utf-8",dir=HOLIDAYS_CACHE_DIR,
+                                         suffix=".tmp",delete=False) as fo:
+            json.dump(table,fo,ensure_ascii=False,separators=(",",":"))
+        os.replace(fo.name,path)
+    except OSError:
+        # the cache is an optimization, a read-only disk only costs recomputation
+        pass
+
+def get_holidays(iso,years):
+    """
+    Sorted (date, name) holidays of a country ("FR") or subdivision ("DE-BY")
+    over years, one entry per name when several fall on the same day.
+
+    Years are computed by the holidays package only once per package version,
+    then read from a compact per-country cache under HOLIDAYS_CACHE_DIR.
+    """
+    country, subdiv = parse_iso(iso)
+    with _holiday_tables_lock:
+        table_lock = _table_locks.setdefault((country,subdiv),threading.Lock())
+    with table_lock:
+        table = _load_table(country,subdiv)
+        missing = [y for y in years if y not in table]
+        if missing:
+            import holidays
+            country_calendar = holidays.country_holidays(country,subdiv=subdiv,years=missing)
+            for y in missing:
+                table[y] = []
+            for day in sorted(country_calendar):
+                for name in country_calendar.get_list(day):
+                    table[day.year].append((day.toordinal(),name))
+            _save_table(country,subdiv,table)
+        return [(date.fromordinal(ordinal),name) for y in years for ordinal, name in table[y]]
 
 """
 cal_header="" "BEGIN:VCALENDAR
@@ -59,52 +151,98 @@ END:VEVENT
     return vevent%(dts,dte,dates,uid,summary,)
 """
 
-def make_country_holiday(iso,start=2000,end=2040):
-    #dates is 
-    dates={}
-    fixed={}
-    moving={}
-    events={}
-    lang="iso"
-    #for date, name in sorted(holidays.DE(prov="BY",years=[2020]).items()):
-    #    dates[name]=date
-    
-    #first go over all the events as we do not know yet:
-    # if they recur
-    # if they recur do they haver yearly recurence or not
-    # non-yearly recurrning will be saved in ical as RDATE
-    years_range = range(start,end)
-    holidays_countries = {"FR":holidays.FR(years=years_range).items,
-                          "GB":holidays.GB(years=years_range).items,
-                          "DE":holidays.DE(prov="BY",years=years_range).items,
-                          "JP":holidays.JP(years=years_range).items
-                            }
-    for date, names in sorted(holidays_countries[iso]()):
-        #names can be comma separated when multiple holiday happen on the same day
-        for name in names.split(", "):
-            if name in events:
-                events[name]["dates"].append(date)
+def iter_holidays(iso,year_start=2000,year_end=None):
+    """
+    sorted (date, name) holidays of iso from year_start to year_end included,
+    or without end, computed HOLIDAYS_CHUNK_YEARS years at a time as iterated
+    """
+    # holidays observed in the following year must still be dates
+    last = date.max.year - 1 if year_end is None else year_end
+    for chunk in range(year_start,last+1,HOLIDAYS_CHUNK_YEARS):
+        yield from get_holidays(iso,range(chunk,min(chunk+HOLIDAYS_CHUNK_YEARS,last+1)))
+
+def classify_series(dates,last_year):
+    """
+    Single pass over the sorted dates of an event to find which yearly pattern
+    they follow, one date per consecutive year:
+    "fixed" (same month and day) or "nth" / "last" (nth or last weekday of
+    the month).
+
+    Returns (kind, rrule), rrule being the most compact RRULE reproducing the
+    dates (with UNTIL when the series stops before last_year).
+    Returns (None, None) for series no RRULE reproduces, to be listed as RDATE:
+    irregular ones, easter offsets, and any the expanded rule does not match.
+    """
+    if len(dates) < 2:
+        return None, None
+    first = dates[0]
+    month, day, weekday = first.month, first.day, first.weekday()
+    nth = (day-1)//7 + 1
+    fixed = by_nth = by_last = True
+    for i, d in enumerate(dates):
+        if d.year != first.year + i:
+            return None, None
+        if d.month != month:
+            fixed = by_nth = by_last = False
+        else:
+            fixed = fixed and d.day == day
+            if d.weekday() != weekday:
+                by_nth = by_last = False
             else:
-                events[name]={"dates":[date],lang:name}
-    moving=events.copy()
-    
+                by_nth = by_nth and (d.day-1)//7 + 1 == nth
+                by_last = by_last and d.day + 7 > days_in_month(d.year,month)
+        if not (fixed or by_nth or by_last):
+            return None, None
+    until = "" if dates[-1].year >= last_year else "UNTIL=%s;" % dates[-1].strftime("%Y%m%d")
+    if fixed:
+        return "fixed", "FREQ=YEARLY;" + until
+    if by_nth or by_last:
+        rule = NthWeekday(month,weekday,nth if by_nth else -1)
+        rrule = rule.rrule.replace("FREQ=YEARLY;","FREQ=YEARLY;"+until)
+        # expanding the rule back has to give the very same dates, else they are listed
+        if rule.series(first.year,dates[-1].year) != dates:
+            return None, None
+        return ("nth" if by_nth else "last"), rrule
+    return None, None
+
+def get_country_holiday_events(iso,start=2000,end=2040):
+    """ DateSeries of every public holiday of iso, by name, over the years range(start,end) """
+    events={}
+    for date, name in get_holidays(iso,range(start,end)):
+        if name in events:
+            events[name].append(date)
+        else:
+            events[name]=DateSeries([date.toordinal()])
+    return events
+
+def calendar_from_events(events,last_year):
+    """
+    rrules and rdates, as expected by write_ical, of holidays dates by name:
+    we do not know yet if they recur, and if they do with a yearly rule or not;
+    non-yearly recurring ones are saved in ical as RDATE
+    """
     rdates = {}
     rrules = {}
-    
-    for event in events:
-        rrule=True
-        for date in events[event]["dates"]:
-            if not ( date.month==events[event]["dates"][0].month and \
-                     date.day==events[event]["dates"][0].day and \
-                     len(events[event]["dates"])==len(years_range)):
-                rrule=False
+    for event, dates in events.items():
+        kind, rrule = classify_series(dates,last_year)
         if rrule:
-            rrules[event.replace("(Observed)","")]={"dtstart":events[event]["dates"][0],"rrule":"FREQ=YEARLY;"}
-            del moving[event]
+            rrules[event.replace("(Observed)","")]={"dtstart":dates[0],"rrule":rrule}
         else:
-            rdates[event.replace("(Observed)","")]=events[event]["dates"]
-    
-    write_ical("%s_ferie_%s_%s.ics"%(iso,start,end),rrules,rdates)
+            rdates[event.replace("(Observed)","")]=dates
+    return rrules,rdates
+
+def get_country_holiday_calendar(iso,start=2000,end=2040):
+    """ rrules and rdates of the public holidays of iso, as expected by write_ical """
+    return calendar_from_events(get_country_holiday_events(iso,start,end),end-1)
+
+def make_country_holiday(iso,start=2000,end=2040,metrics=None):
+    with measured(metrics):
+        with stage(metrics,"dates"):
+            events = get_country_holiday_events(iso,start,end)
+        with stage(metrics,"classification"):
+            rrules, rdates = calendar_from_events(events,end-1)
+        write_ical("%s_ferie_%s_%s.ics"%(iso,start,end),rrules,rdates,
+                   calendar=CALENDAR_ID % iso,metrics=metrics)
     """
     with open("%s_ferie_%s_%s.ics"%(iso,start,end),"w",encoding='utf-8') as fo:
         fo.write(cal_header)
@@ -0,0 +1,226 @@
+""" Serves calendars rendered on demand by the generators over HTTP
+
+    GET /catho/fr/2000-2040.ics
+    GET /doi/DE/2000-2040.ics
+    GET /holidays/DE-BY.ics            (DEFAULT_RANGE)
+    GET /holidays/JP/2000-2040.ics
+    GET /moon/1900-2100.ics
+
+Rendered feeds are kept in a size-bounded LRU with their gzip variant and
+ETag; If-None-Match is answered with 304 and concurrent requests for a feed
+that is being rendered wait for that single render.
+
+usage: python ical_server.py [--host HOST] [--port PORT] [--cache-mb MB]
+"""
+
+import argparse
+import asyncio
+import datetime
+import gzip
+import hashlib
+import io
+import re
+import traceback
+from collections import OrderedDict
+
+from MakeiCal import ICalWriter, iter_vevents
+import catho2ical
+import doi2ical
+import ferie2ical
+import moon2ical
+
+DEFAULT_RANGE = (2000, 2040)
+
+# longest year range a feed can span
+MAX_YEARS = 4000
+
+CACHE_BYTES = 64 << 20
+
+class NotFound(Exception):
+    pass
+
+def parse_path(path):
+    """ "/catho/fr/2000-2040.ics" -> ("catho", "fr", 2000, 2040) """
+    parts = path.strip("/").split("/")
+    if len(parts) < 2 or not parts[-1].endswith(".ics"):
+        raise NotFound(path)
+    generator, last = parts[0], parts[-1][:-len(".ics")]
+    match = re.fullmatch(r"(\d{1,4})-(\d{1,4})", last)
+    if match:
+        start, end = int(match.group(1)), int(match.group(2))
+        locale = parts[1] if len(parts) == 3 else None
+    else:
+        start, end = DEFAULT_RANGE
+        locale = last if len(parts) == 2 else None
+    needs_locale = generator != "moon"
+    if generator not in ("catho", "doi", "holidays", "moon") or needs_locale != (locale is not None) \
+            or not (1 <= start <= end <= 9998 and end - start < MAX_YEARS):
+        raise NotFound(path)
+    return generator, locale, start, end
+
+def render(generator, locale, start, end):
+    """ the .ics bytes of a feed """
+    if generator == "catho":
+        if locale not in ("fr", "en"):
+            raise NotFound(locale)
+        events = iter_vevents(*catho2ical.get_catho_calendar(start, end, locale),
+                              calendar=catho2ical.CALENDAR_ID % locale)
+    elif generator == "doi":
+        calendars = {"FR": doi2ical.get_fr_calendar, "DE": doi2ical.get_de_calendar}
+        if locale not in calendars:
+            raise NotFound(locale)
+        events = iter_vevents(*calendars[locale](start, end), calendar=doi2ical.CALENDAR_ID % locale)
+    elif generator == "holidays":
+        try:
+            calendar = ferie2ical.get_country_holiday_calendar(locale, start, end + 1)
+        except NotImplementedError as e: # unknown country or subdivision
+            raise NotFound(locale) from e
+        events = iter_vevents(*calendar, calendar=ferie2ical.CALENDAR_ID % locale)
+    else:
+        events = moon2ical.moon_vevents(moon2ical.iter_phases(datetime.date(start, 1, 1),
+                                                              datetime.date(end + 1, 1, 1)))
+    fo = io.BytesIO()
+    with ICalWriter(fo) as writer:
+        writer.write_events(events)
+    return fo.getvalue()
+
+class Feed:
+    """ rendered bytes of a calendar, with their gzip variant and the ETag of each """
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip.compress(body, 6, mtime=0)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = '"%s"' % digest
+        # a distinct representation needs a distinct strong ETag
+        self.gzip_etag = '"%s-gzip"' % digest
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzipped)
+
+class FeedCache:
+    """
+    LRU of the rendered feeds bounded by their size in bytes; renders of the
+    same key requested concurrently are coalesced into one
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.feeds = OrderedDict()
+        self.pending = {}
+        self.renders = 0
+
+    async def get(self, key):
+        feed = self.feeds.get(key)
+        if feed is not None:
+            self.feeds.move_to_end(key)
+            return feed
+        pending = self.pending.get(key)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = loop.create_future()
+            self.pending[key] = pending
+            try:
+                self.renders += 1
+                feed = await loop.run_in_executor(None, lambda: Feed(render(*key)))
+            except BaseException as e:
+                pending.set_exception(e)
+                # the exception is raised below, not only to the waiters
+                pending.exception()
+                raise
+            else:
+                pending.set_result(feed)
+                self.put(key, feed)
+            finally:
+                del self.pending[key]
+            return feed
+        return await asyncio.shield(pending)
+
+    def put(self, key, feed):
+        if feed.size > self.max_bytes:
+            return
+        self.feeds[key] = feed
+        self.size += feed.size
+        while self.size > self.max_bytes:
+            _, evicted = self.feeds.popitem(last=False)
+            self.size -= evicted.size
+
+def accepts_gzip(headers):
+    for coding in headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip() in ("gzip", "*") and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            return True
+    return False
+
+def response(status, headers=(), body=b""):
+    lines = ["HTTP/1.1 %s" % status, "Connection: close"]
+    lines += ["%s: %s" % h for h in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+class CalendarServer:
+
+    def __init__(self, cache_bytes=CACHE_BYTES):
+        self.cache = FeedCache(cache_bytes)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            writer.write(await self.respond(request_line.decode("latin-1").split(), headers))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, request, headers):
+        if len(request) != 3:
+            return response("400 Bad Request")
+        method, target, _ = request
+        if method not in ("GET", "HEAD"):
+            return response("405 Method Not Allowed", [("Allow", "GET, HEAD")])
+        try:
+            feed = await self.cache.get(parse_path(target.split("?")[0]))
+        except NotFound:
+            return response("404 Not Found")
+        except Exception:
+            traceback.print_exc()
+            return response("500 Internal Server Error")
+        gzipped = accepts_gzip(headers)
+        etag = feed.gzip_etag if gzipped else feed.etag
+        common = [("ETag", etag), ("Vary", "Accept-Encoding"),
+                  ("Cache-Control", "public, max-age=3600")]
+        if etag in [t.strip() for t in headers.get("if-none-match", "").split(",")]:
+            return response("304 Not Modified", common)
+        body = feed.body
+        if gzipped:
+            body = feed.gzipped
+            common.append(("Content-Encoding", "gzip"))
+        common += [("Content-Type", "text/calendar; charset=utf-8"),
+                   ("Content-Length", str(len(body)))]
+        return response("200 OK", common, body if method == "GET" else b"")
+
+async def serve(host="127.0.0.1", port=8080, cache_bytes=CACHE_BYTES):
+    server = await asyncio.start_server(CalendarServer(cache_bytes).handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves calendars over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-mb", type=int, default=CACHE_BYTES >> 20,
+                        help="size of the rendered feeds cache")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.cache_mb << 20))
+
+if __name__=="__main__":
+    main()
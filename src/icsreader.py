@@ -0,0 +1,201 @@
+""" Streaming .ics reader and round-trip validation of the generated calendars
+
+    python icsreader.py [manifest.json] [--outdir DIR]
+
+reads the outputs of the build manifest (build.DEFAULT_MANIFEST by default)
+and compares, summary by summary, the dates they expand to with the dates
+the generators compute; exits with status 1 when any differs.
+
+    with open("FR_doi_2000_2040.ics", "rb") as fi:
+        for event in read_vevents(fi):
+            expand_vevent(event, 2040)  # array of ordinals, or of seconds for DATE-TIME
+
+RRULEs are expanded as daterules.expand_rrule does (FREQ=YEARLY on DTSTART
+or with BYMONTH and BYDAY, optional UNTIL), up to a last year since they
+recur forever. DATE values expand to ordinals, UTC DATE-TIME values to
+seconds since 0001-01-01, i.e. (ordinal - 1) * 86400 + second of the day.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+from array import array
+
+from daterules import expand_rrule
+
+_text_unescapes = {"\\\\": "\\", "\\;": ";", "\\,": ",", "\\n": "\n", "\\N": "\n"}
+
+def unfold(fo, chunk_size=1 << 20):
+    """ logical content lines (str) of a binary file, folded lines being joined back """
+    pending = b""
+    current = None
+    while True:
+        chunk = fo.read(chunk_size)
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop() if chunk else b""
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            # a continuation line with nothing to continue is kept as a line of its own
+            if line[:1] in (b" ", b"\t") and current is not None:
+                current += line[1:]
+                continue
+            if current is not None:
+                yield current.decode("utf-8")
+            current = line
+        if not chunk:
+            break
+    if current:
+        yield current.decode("utf-8")
+
+def unescape_text(value):
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        pair = value[i:i + 2]
+        if pair in _text_unescapes:
+            out.append(_text_unescapes[pair])
+            i += 2
+        else:
+            out.append(value[i])
+            i += 1
+    return "".join(out)
+
+def read_vevents(fo):
+    """
+    yields the VEVENTs of a calendar as dicts of property name -> value, the
+    values of repeated properties (RDATE) being concatenated into a list
+    """
+    event = None
+    for line in unfold(fo):
+        if event is None:
+            if line == "BEGIN:VEVENT":
+                event = {}
+            continue
+        if line == "END:VEVENT":
+            yield event
+            event = None
+            continue
+        # parameters are not needed, VALUE=DATE values being shorter than DATE-TIME ones
+        head, _, value = line.partition(":")
+        name = head.partition(";")[0]
+        if name == "RDATE":
+            event.setdefault("RDATE", []).extend(value.split(","))
+        elif name == "SUMMARY":
+            event[name] = unescape_text(value)
+        else:
+            event[name] = value
+
+def parse_date(value):
+    return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+def value_key(value):
+    """ ordinal of a DATE value, seconds since 0001-01-01 of a DATE-TIME value """
+    ordinal = parse_date(value).toordinal()
+    if len(value) < 15:
+        return ordinal
+    return (ordinal - 1) * 86400 + int(value[9:11]) * 3600 + int(value[11:13]) * 60 + int(value[13:15])
+
+def expand_vevent(event, last_year):
+    """ sorted occurrences of a VEVENT, its RRULE expanded up to last_year included """
+    dtstart = event["DTSTART"]
+    timed = len(dtstart) >= 15
+    keys = {value_key(dtstart)}
+    keys.update(value_key(v) for v in event.get("RDATE", ()))
+    if "RRULE" in event:
+        if timed:
+            raise ValueError("RRULE with a DATE-TIME DTSTART is not supported")
+        keys.update(expand_rrule(event["RRULE"], parse_date(dtstart), last_year).ordinals)
+    return array("q" if timed else "i", sorted(keys))
+
+def read_calendar(fo, last_year):
+    """ summary -> sorted occurrences of the events of a calendar, see expand_vevent """
+    occurrences = {}
+    for event in read_vevents(fo):
+        # holidays named without their "(Observed)" mark keep a trailing space
+        summary = event.get("SUMMARY", "").strip()
+        occurrences.setdefault(summary, set()).update(expand_vevent(event, last_year))
+    return {summary: array("q", sorted(keys)) for summary, keys in occurrences.items()}
+
+def calendar_occurrences(rrules, rdates, last_year):
+    """ summary -> sorted ordinals of the rrules and rdates of write_ical """
+    occurrences = {}
+    for summary, rule in rrules.items():
+        occurrences.setdefault(summary.strip(), set()).update(
+            expand_rrule(rule["rrule"], rule["dtstart"], last_year).ordinals)
+    for summary, dates in rdates.items():
+        occurrences.setdefault(summary.strip(), set()).update(d.toordinal() for d in dates)
+    return {summary: array("q", sorted(keys)) for summary, keys in occurrences.items()}
+
+def moon_occurrences(events):
+    """ summary -> sorted seconds since 0001-01-01 of (datetime, phase) moon events """
+    occurrences = {}
+    for moment, phase in events:
+        key = (moment.toordinal() - 1) * 86400 + moment.hour * 3600 + moment.minute * 60 + moment.second
+        occurrences.setdefault("Moon - %s" % phase, []).append(key)
+    return {summary: array("q", sorted(keys)) for summary, keys in occurrences.items()}
+
+def diff_occurrences(found, expected):
+    """ summary -> (missing, unexpected) occurrences, for the summaries that differ """
+    diffs = {}
+    for summary in sorted(set(found) | set(expected)):
+        got, want = set(found.get(summary, ())), set(expected.get(summary, ()))
+        if got != want:
+            diffs[summary] = (sorted(want - got), sorted(got - want))
+    return diffs
+
+def expected_occurrences(generator, locale, first_year, last_year):
+    """ what the generator computes from first_year to last_year included, as read_calendar returns it """
+    import shards
+    rrules, rdates, moments = shards.merge_shards([shards.compute_shard(generator, locale, first_year, last_year)])
+    if generator == "moon":
+        return moon_occurrences(moments)
+    if generator == "holidays":
+        # the raw dates, not the RRULEs that classification, under test, would produce
+        rdates = {name.replace("(Observed)", ""): dates for name, dates in rdates.items()}
+    return calendar_occurrences(rrules, rdates, last_year)
+
+def validate_job(job, outdir="."):
+    """ diff_occurrences of the output of a build job against its generator """
+    import build
+    first_year, last_year = build.job_years(job)
+    with open(os.path.join(outdir, build.job_outputs(job)[0]), "rb") as fi:
+        found = read_calendar(fi, last_year)
+    return diff_occurrences(found, expected_occurrences(job["generator"], job.get("locale"),
+                                                        first_year, last_year))
+
+def describe(key, timed=False):
+    """ an occurrence as an ISO date, or datetime when timed (seconds since 0001-01-01) """
+    if timed:
+        return (datetime.datetime(1, 1, 1) + datetime.timedelta(seconds=key)).isoformat()
+    return datetime.date.fromordinal(key).isoformat()
+
+def main():
+    import build
+    parser = argparse.ArgumentParser(description="Checks built calendars against their generators")
+    parser.add_argument("manifest", nargs="?", help="JSON list of jobs, all calendars by default")
+    parser.add_argument("--outdir", default=".", help="directory of the .ics files")
+    args = parser.parse_args()
+    manifest = build.DEFAULT_MANIFEST
+    if args.manifest:
+        with open(args.manifest, encoding="utf-8") as fi:
+            manifest = json.load(fi)
+    failed = False
+    for job in manifest:
+        diffs = validate_job(job, args.outdir)
+        timed = job["generator"] == "moon"
+        print("%-30s %s" % (build.job_name(job), "differs" if diffs else "ok"))
+        for summary, (missing, unexpected) in diffs.items():
+            failed = True
+            print("  %s: %d missing %s, %d unexpected %s" % (
+                summary, len(missing), [describe(k, timed) for k in missing[:3]],
+                len(unexpected), [describe(k, timed) for k in unexpected[:3]]))
+    if failed:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
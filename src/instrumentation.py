@@ -0,0 +1,98 @@
+""" Optional measurements of the generation stages
+
+    metrics = Metrics("FR doi", callback=lambda m: print(m.as_dict()), trace_memory=True)
+    doi2ical.make_fr(2000, 2040, metrics=metrics)
+    metrics.timings   # {"dates": 0.001, "formatting": 0.002, "io": 0.0003, "other": 0.0001,
+                      #  "total": 0.0034} in seconds
+    metrics.counts    # {"events": 11, "dates": 287, "bytes": 10735, "peak_kib": 412}
+
+Generators take metrics=None and then only pay for a None check per stage.
+Stage timings exclude the time of the stages nested in them, so they add up
+to the measured total. With profile=True (or a path to dump the stats to)
+the whole generation also runs under cProfile, kept in metrics.profiler.
+"""
+
+import contextlib
+import time
+
+__all__ = ["Metrics", "stage", "measured", "count"]
+
+class Metrics:
+    """ per-stage timings in seconds, counts (events, dates, bytes...) and optional profiles """
+
+    def __init__(self, name="", callback=None, profile=False, trace_memory=False):
+        self.name = name
+        self.callback = callback
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.timings = {}
+        self.counts = {}
+        self.profiler = None
+        self._nested = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def capture(self):
+        """ runs the block under cProfile and/or tracemalloc when asked, then reports """
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        if self.trace_memory:
+            import tracemalloc
+            tracing = tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+        try:
+            # time spent outside of the instrumented stages
+            with self.stage("other"):
+                if self.profiler is not None:
+                    with self.profiler:
+                        yield self
+                else:
+                    yield self
+        finally:
+            if self.trace_memory:
+                self.counts["peak_kib"] = max(self.counts.get("peak_kib", 0),
+                                              tracemalloc.get_traced_memory()[1] // 1024)
+                if not tracing:
+                    tracemalloc.stop()
+            if self.profiler is not None and isinstance(self.profile, str):
+                self.profiler.dump_stats(self.profile)
+            self.timings["total"] = sum(t for name, t in self.timings.items() if name != "total")
+            if self.callback is not None:
+                self.callback(self)
+
+    def as_dict(self):
+        return {"name": self.name, "timings": dict(self.timings), "counts": dict(self.counts)}
+
+def stage(metrics, name):
+    """ metrics.stage(name), or nothing when metrics is None """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+def measured(metrics):
+    """ metrics.capture() of a make_* entry point, or nothing when metrics is None """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.capture()
+
+def count(metrics, name, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
@@ -0,0 +1,132 @@
+""" One feed combining several generators, without the events they share
+
+    python mergefeed.py holidays:FR doi:FR catho:fr moon [--start 2000] [--end 2040] [--out FR.ics]
+
+The lazy, chronological event streams of the generators are k-way merged
+(heapq.merge); an event whose day and normalized summary were already seen
+that day ("Noël" of the public holidays and of the catholic feasts) is
+skipped, the first source listed winning. Only the keys of the current day
+are kept in the index. The dates left are then grouped by summary and
+written as RRULE or RDATE events, as the generators write them, the moon
+phases staying single timed events.
+"""
+
+import argparse
+import datetime
+import functools
+import heapq
+import unicodedata
+
+from MakeiCal import ICalWriter, iter_vevents
+from dateseries import DateSeries
+import catho2ical
+import doi2ical
+import ferie2ical
+import moon2ical
+
+def source_events(source, year_start, year_end):
+    """
+    (date or datetime, summary) of a source: "catho:fr", "doi:FR",
+    "holidays:DE-BY" or "moon", from year_start to year_end included
+    """
+    generator, _, locale = source.partition(":")
+    if generator == "catho":
+        return catho2ical.iter_catho_events(year_start, year_end, locale)
+    if generator == "doi":
+        return doi2ical.iter_days_of_interest(locale, year_start, year_end)
+    if generator == "holidays":
+        return ferie2ical.iter_holidays(locale, year_start, year_end)
+    if generator == "moon":
+        return moon2ical.iter_phases(datetime.date(year_start, 1, 1), datetime.date(year_end + 1, 1, 1))
+    raise ValueError("unknown source %r" % source)
+
+# summaries repeat every year
+@functools.lru_cache(maxsize=4096)
+def normalize_summary(summary):
+    """ "Noël (observed)" -> "noel": no case, accents, observance mark or punctuation """
+    summary = unicodedata.normalize("NFKD", summary.casefold().replace("(observed)", ""))
+    return " ".join("".join(c if c.isalnum() else " " for c in summary
+                            if not unicodedata.combining(c)).split())
+
+def _sort_key(event):
+    moment = event[0]
+    if isinstance(moment, datetime.datetime):
+        return moment.toordinal(), moment.hour * 3600 + moment.minute * 60 + moment.second
+    return moment.toordinal(), -1
+
+def merge_events(streams, duplicates=None):
+    """
+    (moment, summary, source) of the chronological (moment, summary) streams
+    of a dict source -> stream, merged in chronological order; events with
+    the day and normalized summary of an earlier one are skipped, and added
+    to the duplicates list when given
+    """
+    def tag(source, stream):
+        for moment, summary in stream:
+            yield moment, summary, source
+    tagged = [tag(source, stream) for source, stream in streams.items()]
+    day = None
+    seen = set()
+    for event in heapq.merge(*tagged, key=_sort_key):
+        ordinal = event[0].toordinal()
+        if ordinal != day:
+            day = ordinal
+            seen.clear()
+        key = normalize_summary(event[1])
+        if key in seen:
+            if duplicates is not None:
+                duplicates.append(event)
+            continue
+        seen.add(key)
+        yield event
+
+def merged_vevents(events, calendar, last_year):
+    """
+    VEVENTs of merged events: the dates of each summary as one RRULE or RDATE
+    event (see ferie2ical.calendar_from_events), the moon phases as
+    moon2ical writes them
+    """
+    dates = {}
+    moments = []
+    for moment, summary, source in events:
+        if source == "moon":
+            moments.append((moment, summary))
+        else:
+            dates.setdefault(summary, DateSeries()).append(moment)
+    # the sources are finite, every series is complete here
+    rrules, rdates = ferie2ical.calendar_from_events(dates, last_year)
+    yield from iter_vevents(rrules, rdates, calendar)
+    yield from moon2ical.moon_vevents(moments)
+
+def write_merged_feed(fo, sources, year_start, year_end, calendar="1-annum"):
+    """
+    writes the merged feed of sources to the binary file fo,
+    returns (occurrences written, duplicates skipped)
+    """
+    streams = {source: source_events(source, year_start, year_end) for source in sources}
+    duplicates = []
+    written = 0
+    def counted(events):
+        nonlocal written
+        for event in events:
+            written += 1
+            yield event
+    with ICalWriter(fo) as writer:
+        writer.write_events(merged_vevents(counted(merge_events(streams, duplicates)), calendar, year_end))
+    return written, len(duplicates)
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes one feed merging several generators")
+    parser.add_argument("sources", nargs="+", help="catho:fr, doi:FR, holidays:FR, moon...")
+    parser.add_argument("--start", type=int, default=2000)
+    parser.add_argument("--end", type=int, default=2040, help="last year, included")
+    parser.add_argument("--out", help="feed file, merged_<start>_<end>.ics by default")
+    args = parser.parse_args()
+    fn = args.out or "merged_%s_%s.ics" % (args.start, args.end)
+    with open(fn, "wb") as fo:
+        written, duplicates = write_merged_feed(fo, args.sources, args.start, args.end,
+                                                calendar="+".join(args.sources))
+    print("%d events saved in %s, %d duplicates skipped" % (written, fn, duplicates))
+
+if __name__=="__main__":
+    main()
@@ -6,63 +6,13 @@ Cf. http://en.wikipedia.org/wiki/Lunar_phase#Lunar_phase_calculation
 """
 
 import math, decimal, datetime
-import uuid
+import bisect
+import itertools
 
-dec = decimal.Decimal
-
-ical_openings="""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:1-annum
-"""
+from MakeiCal import ICalWriter, event_uid, fold_line, format_datetime, format_datetimes
+from instrumentation import count, measured, stage
 
-first_quarter_ical_str="""BEGIN:VEVENT
-UID:%s@1-annum.com
-CATEGORIES:MOON
-DTSTAMP:20201231T103500Z
-TRANSP:TRANSPARENT
-LAST-MODIFIED:20201231T103500Z
-STATUS:CONFIRMED
-DTSTART:%s
-DTEND:%s
-SUMMARY:Moon - First Quarter
-END:VEVENT
-"""
-last_quarter_ical_str="""BEGIN:VEVENT
-UID:%s@1-annum.com
-CATEGORIES:MOON
-DTSTAMP:20201231T103500Z
-TRANSP:TRANSPARENT
-LAST-MODIFIED:20201231T103500Z
-STATUS:CONFIRMED
-DTSTART:%s
-DTEND:%s
-SUMMARY:Moon - Last Quarter
-END:VEVENT
-"""
-full_moon_ical_str="""BEGIN:VEVENT
-UID:%s@1-annum.com
-CATEGORIES:MOON
-DTSTAMP:20201231T103500Z
-TRANSP:TRANSPARENT
-LAST-MODIFIED:20201231T103500Z
-STATUS:CONFIRMED
-DTSTART:%s
-DTEND:%s
-SUMMARY:Moon - Full Moon
-END:VEVENT
-"""
-new_moon_ical_str="""BEGIN:VEVENT
-UID:%s@1-annum.com
-CATEGORIES:MOON
-DTSTAMP:20201231T103500Z
-TRANSP:TRANSPARENT
-LAST-MODIFIED:20201231T103500Z
-STATUS:CONFIRMED
-DTSTART:%s
-DTEND:%s
-SUMMARY:Moon - New Moon
-END:VEVENT
-"""
+dec = decimal.Decimal
 
 
 def position(now=None): 
@@ -89,10 +39,10 @@ def phase(pos):
       7: "Waning Crescent"
    }[int(index) & 7]
 
-def get_list_phases(year_start=2001,year_end=2030):
+def get_list_phases_loop(year_start=2001,year_end=2030):
+    """ Reference day-by-day implementation, kept for benchmarking. """
     delta_start = (datetime.date(year_start,1,1)-datetime.date(2001,1,1)).days
     delta_end = (datetime.date(year_end,12,31)-datetime.date(2001,1,1)).days 
-    print(38,delta_start,delta_end)
     last_year_date = datetime.datetime(2001,1,1)+datetime.timedelta(days=delta_start-1)
     pos=position(last_year_date)
     prev = round(float(pos), 3)
@@ -129,23 +79,162 @@ def get_list_phases(year_start=2001,year_end=2030):
     #print("%s %s (%s)" % (date_query, phasename, roundedpos))
     return list_days
     
-def make_ical(year_start=2000,year_end=2040):
-    list_days = get_list_phases(year_start,year_end)
-    with open("moon_%s_%s.ics"%(year_start,year_end),"w") as fo:
-        fo.write(ical_openings)
-        for day in list_days:
-            event_uuid = str(uuid.uuid4())
-            dts = day[0].strftime("%Y%m%dT%H%m%SZ")
-            dte = day[0].strftime("%Y%m%dT%H%m%SZ") 
-            if day[1]=="First Quarter":
-                fo.write(first_quarter_ical_str%(event_uuid,dts,dte))
-            elif day[1]=="Last Quarter":
-                fo.write(last_quarter_ical_str%(event_uuid,dts,dte))
-            elif day[1]=="New Moon":
-                fo.write(new_moon_ical_str%(event_uuid,dts,dte))
-            elif day[1]=="Full Moon":
-                fo.write(full_moon_ical_str%(event_uuid,dts,dte))
-        fo.write("END:VCALENDAR")
+# position() scaled by 1e11 so that a whole range can be evaluated exactly
+# with int64 arithmetic: 0.20439731 + days * 0.03386319269
+POSITION_EPOCH = datetime.datetime(2001, 1, 1)
+POSITION_OFFSET = 20439731000
+POSITION_RATE = 3386319269
+POSITION_SCALE = 10**11
+ROUNDING_SCALE = 10**8 # from 1e-11 to 1e-3 units
+
+def positions(days):
+    """
+    Rounded lunar positions (as round(float(position()), 3) would return them)
+    for an array of day offsets from 2001-01-01 at midnight.
+    """
+    import numpy as np
+    lunations = POSITION_OFFSET + np.asarray(days, dtype=np.int64) * POSITION_RATE
+    # decimal's % keeps the sign of the dividend, as np.fmod does
+    pos = np.fmod(lunations, POSITION_SCALE)
+    magnitude = np.abs(pos)
+    rounded = np.sign(pos) * ((magnitude + ROUNDING_SCALE // 2) // ROUNDING_SCALE)
+    rounded = rounded / 1000
+    # exact ties on the third decimal depend on the binary value of the float
+    for i in np.flatnonzero(magnitude % ROUNDING_SCALE == ROUNDING_SCALE // 2):
+        rounded[i] = round(float(pos[i]) / POSITION_SCALE, 3)
+    return rounded
+
+def get_list_phases(year_start=2001,year_end=2030):
+    """
+    Vectorized equivalent of get_list_phases_loop: all the days of the range
+    are positioned at once and quarter crossings are found with array masks.
+    """
+    delta_start = (datetime.date(year_start,1,1)-POSITION_EPOCH.date()).days
+    delta_end = (datetime.date(year_end,12,31)-POSITION_EPOCH.date()).days
+    if delta_end <= delta_start:
+        return []
+    # numpy is only loaded by the daily sampling, phase_events does not need it
+    import numpy as np
+    # one extra day before the range provides the first "prev" position
+    days = np.arange(delta_start-1, delta_end, dtype=np.int64)
+    rounded = positions(days)
+    prev = rounded[:-1]
+    cur = rounded[1:]
+
+    new_moon = (cur<0.05) & (prev>0.95)
+    last_quarter = ~new_moon & (cur>0.75) & (prev<0.75)
+    first_quarter = ~new_moon & ~last_quarter & (cur>0.25) & (prev<0.25)
+    full_moon = ~new_moon & ~last_quarter & ~first_quarter & (cur>0.5) & (prev<0.5)
+
+    # when the day before is closer to the exact phase, it is reported instead
+    use_prev = np.where(new_moon, np.abs(prev-1)>np.abs(cur), False)
+    for mask, target in ((last_quarter, 0.75), (first_quarter, 0.25), (full_moon, 0.5)):
+        use_prev |= mask & (np.abs(prev-target)<np.abs(cur-target))
+
+    names = np.full(cur.shape, -1, dtype=np.int8)
+    names[new_moon] = 0
+    names[first_quarter] = 1
+    names[full_moon] = 2
+    names[last_quarter] = 3
+    hits = np.flatnonzero(names >= 0)
+    labels = ("New Moon", "First Quarter", "Full Moon", "Last Quarter")
+    list_days = []
+    for i, offset in zip(hits.tolist(), (days[1:][hits] - use_prev[hits]).tolist()):
+        list_days.append((POSITION_EPOCH+datetime.timedelta(days=offset),labels[names[i]]))
+    return list_days
+
+LUNATION_ORIGIN = 0.20439731
+LUNATIONS_PER_DAY = 0.03386319269
+QUARTER_NAMES = ("New Moon", "First Quarter", "Full Moon", "Last Quarter")
+
+def _as_datetime(day):
+    if isinstance(day, datetime.datetime):
+        return day
+    return datetime.datetime(day.year, day.month, day.day)
+
+def iter_phases(start, end=None):
+    """
+    (datetime, phase) for every new moon, quarter and full moon in [start, end[,
+    or from start on when end is None, computed one event at a time as iterated.
+
+    position() is linear in time, so each quarter k (k/4 lunations since the
+    origin) happens at (k/4 - 0.20439731) / 0.03386319269 days after
+    2001-01-01: one evaluation per event, to the second, no daily sampling.
+    """
+    start = _as_datetime(start)
+    end = _as_datetime(end) if end is not None else None
+    diff = start - POSITION_EPOCH
+    days = diff.days + diff.seconds / 86400
+    # one quarter of margin, float rounding is settled by the comparisons
+    for k in itertools.count(math.floor(4 * (LUNATION_ORIGIN + days * LUNATIONS_PER_DAY)) - 1):
+        days = (k / 4 - LUNATION_ORIGIN) / LUNATIONS_PER_DAY
+        try:
+            moment = POSITION_EPOCH + datetime.timedelta(seconds=round(days * 86400))
+        except OverflowError:
+            if days < 0: # the quarter of margin before year 1
+                continue
+            return # past year 9999
+        if end is not None and moment >= end:
+            return
+        if moment >= start:
+            yield moment, QUARTER_NAMES[k % 4]
+
+def phase_events(start, end):
+    """ list of the (datetime, phase) of iter_phases(start, end) """
+    return list(iter_phases(start, end))
+
+def clip_events(events, first, last):
+    """ the (datetime, phase) of a chronological list happening from the day first to the day last included """
+    first, last = _as_datetime(first), _as_datetime(last) + datetime.timedelta(days=1)
+    lo = bisect.bisect_left(events, first, key=lambda event: event[0])
+    return events[lo:bisect.bisect_left(events, last, lo, key=lambda event: event[0])]
+
+def moon_vevent_lines(moment,phasename,uid=None,dts=None):
+    """
+    yields the encoded lines of the VEVENT of a lunar phase, dts being the
+    already formatted moment if available
+    """
+    dts = dts or format_datetime(moment)
+    yield fold_line("BEGIN:VEVENT")
+    yield fold_line("UID:%s" % (uid or event_uid("moon",phasename,dts)))
+    yield fold_line("CATEGORIES:MOON")
+    yield fold_line("DTSTAMP:20201231T103500Z")
+    yield fold_line("TRANSP:TRANSPARENT")
+    yield fold_line("LAST-MODIFIED:20201231T103500Z")
+    yield fold_line("STATUS:CONFIRMED")
+    yield fold_line("DTSTART:%s" % dts)
+    yield fold_line("DTEND:%s" % dts)
+    yield fold_line("SUMMARY:Moon - %s" % phasename)
+    yield fold_line("END:VEVENT")
+
+def moon_vevents(list_days):
+    """ VEVENTs (as iterables of encoded lines) for (datetime, phase) pairs """
+    list_days, moments = itertools.tee(list_days)
+    for day, dts in zip(list_days, format_datetimes(day[0] for day in moments)):
+        yield moon_vevent_lines(day[0],day[1],dts=dts)
+
+def make_ical(year_start=2000,year_end=2040,metrics=None,window=None):
+    """
+    window, (first, last) days such as MakeiCal.rolling_window() returns,
+    limits the phases to that window within the years
+    """
+    start, end = datetime.date(year_start,1,1), datetime.date(year_end+1,1,1)
+    if window is not None:
+        # phases are computed by a closed form, there is nothing to clip afterwards
+        start, end = max(start,window[0]), min(end,window[1]+datetime.timedelta(days=1))
+    with measured(metrics):
+        list_days = iter_phases(start,max(start,end))
+        if metrics is not None:
+            # computed upfront to time it apart from the formatting
+            with stage(metrics,"dates"):
+                list_days = list(list_days)
+            count(metrics,"events",len(list_days))
+        with stage(metrics,"io"):
+            fo = open("moon_%s_%s.ics"%(year_start,year_end),"wb")
+        with fo:
+            with stage(metrics,"formatting"), ICalWriter(fo,metrics=metrics) as writer:
+                writer.write_events(moon_vevents(list_days))
+            count(metrics,"bytes",writer.bytes_written)
     
 
 def main(): 
@@ -0,0 +1,105 @@
+""" Year-range sharding of the calendars spanning centuries
+
+A long range is cut into blocks of years aligned on multiples of the shard
+size (1583-4099 by 100 years: 1583-1599, 1600-1699, ..., 4000-4099), so that
+extending a range only adds blocks. Each block is computed on its own into
+a JSON-serializable shard, and the shards are merged back in year order into
+the rrules and rdates of one calendar:
+
+    shards = [compute_shard("catho", "fr", s, e) for s, e in shard_ranges(1583, 4099, 100)]
+    write_merged("catho", "fr", 4099, "catho_1583_4099_fr.ics", merge_shards(shards))
+"""
+
+import datetime
+
+from MakeiCal import ICalWriter, write_ical
+from dateseries import DateSeries
+from instrumentation import count, measured, stage
+import catho2ical
+import doi2ical
+import ferie2ical
+import moon2ical
+
+def shard_ranges(start,end,size):
+    """ inclusive (start, end) blocks of [start, end], aligned on multiples of size years """
+    ranges = []
+    block = start
+    while block <= end:
+        block_end = min((block // size + 1) * size - 1, end)
+        ranges.append((block, block_end))
+        block = block_end + 1
+    return ranges
+
+def _ordinals(dates):
+    if isinstance(dates, DateSeries):
+        return dates.ordinals.tolist()
+    return [d.toordinal() for d in dates]
+
+def compute_shard(generator,locale,start,end):
+    """
+    events of a generator over the years start to end included, as
+    {"rrules": {name: [dtstart ordinal, rrule]}, "rdates": {name: [ordinals]},
+     "moments": [[ISO datetime, phase]]}
+    """
+    rrules, rdates, moments = {}, {}, []
+    if generator == "catho":
+        rrules, rdates = catho2ical.get_catho_calendar(start,end,locale)
+    elif generator == "doi":
+        rrules, rdates = {"FR": doi2ical.get_fr_calendar, "DE": doi2ical.get_de_calendar}[locale](start,end)
+    elif generator == "holidays":
+        # classified into rrules once merged, a block alone does not tell how they recur
+        rdates = ferie2ical.get_country_holiday_events(locale,start,end+1)
+    elif generator == "moon":
+        moments = [(moment.isoformat(), phase) for moment, phase in
+                   moon2ical.phase_events(datetime.date(start,1,1),datetime.date(end+1,1,1))]
+    else:
+        raise ValueError("unknown generator %r" % generator)
+    return {"rrules": {name: [rule["dtstart"].toordinal(), rule["rrule"]] for name, rule in rrules.items()},
+            "rdates": {name: _ordinals(dates) for name, dates in rdates.items()},
+            "moments": [list(m) for m in moments]}
+
+def merge_shards(shards):
+    """
+    rrules, rdates and moon moments of consecutive shards: the RDATE series
+    of an event are concatenated, an rrule keeps the dtstart of the first
+    shard it appears in
+    """
+    rrules, rdates, moments = {}, {}, []
+    for shard in shards:
+        for name, (dtstart, rrule) in shard["rrules"].items():
+            if name not in rrules:
+                rrules[name] = {"dtstart": datetime.date.fromordinal(dtstart), "rrule": rrule}
+            elif rrules[name]["rrule"] != rrule:
+                raise ValueError("%s recurs as %s and as %s" % (name, rrules[name]["rrule"], rrule))
+        for name, ordinals in shard["rdates"].items():
+            series = rdates.get(name)
+            if series is None:
+                rdates[name] = DateSeries(ordinals)
+            elif not ordinals:
+                continue
+            elif not series or ordinals[0] > series.ordinals[-1]:
+                series.ordinals.extend(ordinals)
+            else:
+                # an observed holiday moved across the new year
+                rdates[name] = series | DateSeries(ordinals)
+        moments.extend((datetime.datetime.fromisoformat(m), phase) for m, phase in shard["moments"])
+    return rrules, rdates, moments
+
+CALENDAR_IDS = {"catho": catho2ical.CALENDAR_ID, "doi": doi2ical.CALENDAR_ID,
+                "holidays": ferie2ical.CALENDAR_ID}
+
+def write_merged(generator,locale,last_year,fn,merged,metrics=None):
+    """ writes merged shards to fn as write_ical or moon2ical.make_ical would """
+    rrules, rdates, moments = merged
+    with measured(metrics):
+        if generator == "moon":
+            count(metrics,"events",len(moments))
+            with open(fn,"wb") as fo:
+                with stage(metrics,"formatting"), ICalWriter(fo,metrics=metrics) as writer:
+                    writer.write_events(moon2ical.moon_vevents(moments))
+            count(metrics,"bytes",writer.bytes_written)
+            return
+        if generator == "holidays":
+            with stage(metrics,"classification"):
+                rrules, rdates = ferie2ical.calendar_from_events(rdates,last_year)
+        write_ical(fn,rrules,rdates,calendar=CALENDAR_IDS[generator] % locale,metrics=metrics)